@@ -3,6 +3,7 @@ Moodify - Dynamic Song Recommendations
 Different songs every time, no repetition
 """
 
+import abc
 import cv2
 import numpy as np
 import base64
@@ -13,17 +14,34 @@ import time
 import random
 import re
 import math
-from collections import deque, Counter
+import sys
+import threading
+import queue
+import zlib
+import http.client
+import codecs
+import contextlib
+import sqlite3
+import bisect
+import itertools
+import functools
+import cProfile
+import pstats
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque, OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import urllib.parse
-import urllib.request
 
 # Web framework
-from flask import Flask, render_template_string, jsonify, request
+from flask import Flask, Response, render_template_string, jsonify, request
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
 
+from measure import percentile
+from message_queue import LocalBrokerManager
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -35,7 +53,94 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'moodify-secret-key-2024'
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+
+# Multi-process settings (see cluster.py)
+WORKER_ID = os.environ.get('MOODIFY_WORKER_ID', '')  # Prefixes session ids so the proxy can route them
+MESSAGE_QUEUE = os.environ.get('MOODIFY_MESSAGE_QUEUE', '')  # local://host:port, redis://..., amqp://...
+
+if MESSAGE_QUEUE.startswith('local://'):
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading',
+                        client_manager=LocalBrokerManager(MESSAGE_QUEUE))
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading',
+                        message_queue=MESSAGE_QUEUE or None)
+
+if WORKER_ID:
+    _generate_sid = socketio.server.eio.generate_id
+    socketio.server.eio.generate_id = lambda: f'{WORKER_ID}.{_generate_sid()}'
+
+# Session settings
+SESSION_IDLE_TIMEOUT = int(os.environ.get('MOODIFY_SESSION_IDLE_TIMEOUT', 300))
+SESSION_REAP_INTERVAL = 30
+
+# Detection engine settings
+DETECTION_WORKERS = int(os.environ.get('MOODIFY_DETECTION_WORKERS', os.cpu_count() or 2))
+DETECTION_SCALE = float(os.environ.get('MOODIFY_DETECTION_SCALE', 1.0))  # 0.5 = half resolution
+FACE_MIN_SIZE = 60
+FACE_TRACKING = os.environ.get('MOODIFY_FACE_TRACKING', '1') != '0'
+FULL_SCAN_INTERVAL = int(os.environ.get('MOODIFY_FULL_SCAN_INTERVAL', 10))  # Frames between full-frame scans
+TRACKING_MARGIN = 0.5  # Search window grows by this fraction of the face size on each side
+SIMILARITY_THRESHOLD = float(os.environ.get('MOODIFY_SIMILARITY_THRESHOLD', 3.0))  # Mean abs diff, 0 disables
+SIGNATURE_SIZE = (16, 12)
+
+# Temporal smoothing: 'majority', 'ema' or 'hysteresis'
+SMOOTHING_STRATEGY = os.environ.get('MOODIFY_SMOOTHING', 'majority')
+SMOOTHING_WINDOW = int(os.environ.get('MOODIFY_SMOOTHING_WINDOW', 10))  # Frames
+SMOOTHING_WARMUP = int(os.environ.get('MOODIFY_SMOOTHING_WARMUP', 5))  # Frames before the first switch
+SMOOTHING_HOLD = float(os.environ.get('MOODIFY_SMOOTHING_HOLD', 3.0))  # Seconds between switches
+SMOOTHING_MAJORITY = float(os.environ.get('MOODIFY_SMOOTHING_MAJORITY', 0.6))
+SMOOTHING_ALPHA = float(os.environ.get('MOODIFY_SMOOTHING_ALPHA', 0.3))  # EMA weight of the newest frame
+SMOOTHING_ENTER = float(os.environ.get('MOODIFY_SMOOTHING_ENTER', 0.7))  # Hysteresis: share to take over
+SMOOTHING_STAY = float(os.environ.get('MOODIFY_SMOOTHING_STAY', 0.3))  # Hysteresis: share to hold on
+
+EMOTIONS = ('happy', 'neutral', 'sad')
+EMOTION_INDEX = {emotion: i for i, emotion in enumerate(EMOTIONS)}
+
+# Played songs remembered per session
+PLAYED_HISTORY_LIMIT = int(os.environ.get('MOODIFY_PLAYED_HISTORY_LIMIT', 2000))
+
+# Capture rate the server recommends to each client
+CAPTURE_INTERVAL_MIN = int(os.environ.get('MOODIFY_CAPTURE_INTERVAL_MIN', 200))  # ms
+CAPTURE_INTERVAL_MAX = int(os.environ.get('MOODIFY_CAPTURE_INTERVAL_MAX', 1000))  # ms
+CAPTURE_BACKOFF = 1.25  # Interval growth per frame while nothing changes
+
+# Emotion classifier: 'heuristic' or 'fer'
+EMOTION_BACKEND = os.environ.get('MOODIFY_EMOTION_BACKEND', 'heuristic')
+
+# Song search settings
+SEARCH_WORKERS = int(os.environ.get('MOODIFY_SEARCH_WORKERS', 4))
+SEARCH_QUEUE_LIMIT = int(os.environ.get('MOODIFY_SEARCH_QUEUE_LIMIT', 32))
+
+# Song pool settings
+SONG_POOL_TTL = int(os.environ.get('MOODIFY_SONG_POOL_TTL', 1800))
+SONG_POOL_LOW_WATER = int(os.environ.get('MOODIFY_SONG_POOL_LOW_WATER', 20))
+SONG_POOL_CAPACITY = int(os.environ.get('MOODIFY_SONG_POOL_CAPACITY', 100))
+SONG_POOL_REFILL_QUERIES = 4
+
+# Files the app writes live next to it, not in the current directory
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Song catalog settings ('' disables the on-disk catalog)
+CATALOG_PATH = os.environ.get('MOODIFY_CATALOG_PATH', os.path.join(APP_DIR, 'moodify_catalog.db'))
+CATALOG_SCAN_LIMIT = 500  # Rows examined per sample before giving up on exclusions
+
+# Search backend; point it at fixture_server.py to run without network access
+YOUTUBE_BASE_URL = os.environ.get('MOODIFY_YOUTUBE_BASE_URL', 'https://www.youtube.com')
+SEARCH_SEED = os.environ.get('MOODIFY_SEED')  # Makes query generation reproducible
+
+# Recently used search queries that won't be repeated
+QUERY_HISTORY_SIZE = int(os.environ.get('MOODIFY_QUERY_HISTORY_SIZE', 500))
+
+# Profiler settings
+PROFILE_DIR = os.environ.get('MOODIFY_PROFILE_DIR', os.path.join(APP_DIR, 'profiles'))
+PROFILE_MAX_DURATION = 600  # Seconds a profiling window may last
+ADMIN_TOKEN = os.environ.get('MOODIFY_ADMIN_TOKEN', '')  # Unset: admin endpoints answer localhost only
+
+# HTTP client settings
+HTTP_POOL_SIZE = int(os.environ.get('MOODIFY_HTTP_POOL_SIZE', 8))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('MOODIFY_HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(os.environ.get('MOODIFY_HTTP_READ_TIMEOUT', 10))
+HTTP_DRAIN_LIMIT = int(os.environ.get('MOODIFY_HTTP_DRAIN_LIMIT', 256 * 1024))  # Raw bytes read past an early stop
 
 # HTML Template - Simplified UI without percentages
 HTML_TEMPLATE = """
@@ -626,6 +731,11 @@ HTML_TEMPLATE = """
             setupSocketEvents() {
                 this.socket.on('connect', () => {
                     document.getElementById('statusDot').classList.remove('offline');
+                    
+                    // A new connection starts a fresh server session, restore its played history
+                    if (this.playedSongs.size > 0) {
+                        this.socket.emit('song_played', { videoIds: Array.from(this.playedSongs) });
+                    }
                     this.showToast('✓ Connected');
                 });
 
@@ -684,7 +794,8 @@ HTML_TEMPLATE = """
                     document.getElementById('statusText').textContent = 'Detecting...';
                     
                     this.showToast('Camera started');
-                    this.captureLoop();
+                    this.captureLoopId = (this.captureLoopId || 0) + 1;
+                    this.captureLoop(this.captureLoopId);
                 } catch (error) {
                     this.showToast('Camera access denied');
                 }
@@ -705,28 +816,36 @@ HTML_TEMPLATE = """
                 document.getElementById('faceBadge').classList.remove('detected');
             }
 
-            captureLoop() {
-                if (!this.isDetecting) return;
+            captureLoop(loopId) {
+                // A stop/start while waiting for an ack must not leave two loops running
+                if (!this.isDetecting || loopId !== this.captureLoopId) return;
                 
                 this.ctx.drawImage(this.video, 0, 0, 640, 480);
-                const imageData = this.canvas.toDataURL('image/jpeg', 0.7);
                 
                 const noRepeat = document.getElementById('noRepeatSwitch').checked;
+                // The server recommends when to send the next frame
+                const next = (delay) => setTimeout(() => this.captureLoop(loopId), delay || 200);
                 
-                this.socket.emit('process_frame', { 
-                    image: imageData,
-                    played_songs: noRepeat ? Array.from(this.playedSongs) : []
-                });
-                
-                setTimeout(() => this.captureLoop(), 200);
+                // Send the JPEG as a binary attachment, no base64 data URL
+                this.canvas.toBlob(async (blob) => {
+                    if (!blob || !this.isDetecting) {
+                        next();
+                        return;
+                    }
+                    
+                    // Wait for the server to take the frame before capturing the next one
+                    this.socket.timeout(2000).emit('process_frame_binary', { 
+                        image: await blob.arrayBuffer(),
+                        no_repeat: noRepeat
+                    }, (err, ack) => next(ack && ack.next_interval_ms));
+                }, 'image/jpeg', 0.7);
             }
 
             refreshSongs() {
                 if (this.currentEmotion) {
                     this.showToast('Getting new songs...');
                     this.socket.emit('refresh_songs', { 
-                        emotion: this.currentEmotion,
-                        played_songs: Array.from(this.playedSongs)
+                        emotion: this.currentEmotion
                     });
                 }
             }
@@ -784,8 +903,9 @@ HTML_TEMPLATE = """
                 const song = this.currentSongs[index];
                 if (!song) return;
                 
-                // Track played song
+                // Track played song, the server keeps its own copy
                 this.playedSongs.add(song.videoId);
+                this.socket.emit('song_played', { videoId: song.videoId });
                 
                 // Update playing state
                 document.querySelectorAll('.song-item').forEach((item, i) => {
@@ -829,115 +949,779 @@ HTML_TEMPLATE = """
 </html>
 """
 
-class ImprovedEmotionDetector:
-    """Improved emotion detection that properly detects all three emotions"""
-    
+# Metrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+
+class _ShardHolder:
+    """Thread-local owner of one shard; its finalizer runs when the thread exits"""
+
+    __slots__ = ('values', '__weakref__')
+
+    def __init__(self, values: list):
+        self.values = values
+
+class _ThreadSharded:
+    """Per-thread list of numbers, so updates never contend on a lock.
+
+    Each thread writes only its own shard; the lock is taken once per
+    thread to register the shard and when a scrape sums them up. When a
+    thread exits its shard is folded into a base total, so short-lived
+    handler threads don't pile up shards.
+    """
+
+    def __init__(self, name: str, help_text: str, width: int):
+        self.name = name
+        self.help = help_text
+        self._width = width
+        self._local = threading.local()
+        self._shards: Dict[int, list] = {}
+        self._base = [0] * width  # Totals of exited threads
+        self._lock = threading.RLock()  # Finalizers may run while a scrape holds it
+
+    def _shard(self) -> list:
+        try:
+            return self._local.holder.values
+        except AttributeError:
+            values = [0] * self._width
+            holder = self._local.holder = _ShardHolder(values)
+            with self._lock:
+                self._shards[id(values)] = values
+            weakref.finalize(holder, self._retire, values)
+            return values
+
+    def _retire(self, values: list):
+        with self._lock:
+            if self._shards.pop(id(values), None) is not None:
+                self._base = [total + value for total, value in zip(self._base, values)]
+
+    def _totals(self) -> list:
+        with self._lock:
+            return [sum(column) for column in zip(self._base, *self._shards.values())]
+
+class MetricCounter(_ThreadSharded):
+    """Monotonic counter"""
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text, 1)
+
+    def inc(self, amount: int = 1):
+        self._shard()[0] += amount
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter',
+                f'{self.name} {self._totals()[0]}']
+
+class MetricHistogram(_ThreadSharded):
+    """Cumulative-bucket histogram; the shard holds one count per bucket plus the sum"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, len(self.buckets) + 2)  # Buckets, +Inf, sum
+
+    def observe(self, value: float):
+        shard = self._shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def render(self) -> List[str]:
+        totals = self._totals()
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {totals[-1]:.6f}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+class MetricGauge:
+    """Value read from a callback at scrape time"""
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+class MetricsRegistry:
+    """Metrics exposed at /metrics in the Prometheus text format"""
+
     def __init__(self):
-        # Load cascades
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        self.eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
-        self.smile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_smile.xml')
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str) -> MetricCounter:
+        return self._register(MetricCounter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> MetricHistogram:
+        return self._register(MetricHistogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, read) -> MetricGauge:
+        return self._register(MetricGauge(name, help_text, read))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+frame_decode_seconds = metrics.histogram('moodify_frame_decode_seconds', 'JPEG decode and grayscale conversion time')
+face_detection_seconds = metrics.histogram('moodify_face_detection_seconds', 'Face detection time per analysed frame')
+emotion_analysis_seconds = metrics.histogram('moodify_emotion_analysis_seconds', 'Emotion classification time per face')
+search_songs_seconds = metrics.histogram('moodify_search_songs_seconds', 'search_songs latency')
+search_youtube_seconds = metrics.histogram('moodify_search_youtube_seconds', 'Latency of one YouTube results page scrape')
+songs_per_search = metrics.histogram('moodify_songs_per_search', 'Songs returned by search_songs',
+                                     buckets=(0, 1, 2, 5, 8, 10, 15))
+frames_processed = metrics.counter('moodify_frames_processed_total', 'Frames run through detection')
+faces_found = metrics.counter('moodify_faces_found_total', 'Frames with a face')
+faces_missed = metrics.counter('moodify_faces_missed_total', 'Frames without a face')
+emotion_changes = metrics.counter('moodify_emotion_changes_total', 'Stable emotion switches across all sessions')
+search_failures = metrics.counter('moodify_search_failures_total', 'Failed YouTube scrapes and song searches')
+
+class SamplingProfiler:
+    """Profiles a sampled fraction of handler calls for a bounded window.
+
+    Idle, a wrapped call costs one attribute check. While a window is open
+    each sampled call runs under its own cProfile.Profile and the results
+    are merged per handler; closing the window writes one .prof file per
+    handler, readable with pstats, snakeviz or flameprof.
+    """
+
+    def __init__(self, output_dir: str = PROFILE_DIR):
+        self.output_dir = output_dir
+        self.active = False
+        self.sample_rate = 0.0
+        self.until = 0.0
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._calls: Dict[str, int] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._timer = None
+        self._rng = random.Random()
+        self.last_files: List[str] = []
+
+    def profiled(self, name: str):
+        """Decorator that makes a function eligible for sampling"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.active:
+                    return fn(*args, **kwargs)
+                return self._sample(name, fn, args, kwargs)
+            return wrapper
+        return decorator
+
+    def call(self, name: str, fn, *args):
+        """Call fn(*args), profiling it if sampled"""
+        if not self.active:
+            return fn(*args)
+        return self._sample(name, fn, args, {})
+
+    def _sample(self, name: str, fn, args, kwargs):
+        # Nested calls on a profiled thread are already covered by the outer profile
+        if (getattr(self._local, 'busy', False) or time.time() >= self.until or
+                self._rng.random() >= self.sample_rate):
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process
+            return fn(*args, **kwargs)
+        self._local.busy = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._local.busy = False
+            with self._lock:
+                if name in self._stats:
+                    self._stats[name].add(profile)
+                else:
+                    self._stats[name] = pstats.Stats(profile)
+                self._calls[name] = self._calls.get(name, 0) + 1
+
+    def start(self, duration: float = 30.0, sample_rate: float = 0.1) -> Dict:
+        """Open a profiling window; it closes itself after duration seconds"""
+        duration = min(PROFILE_MAX_DURATION, max(1.0, float(duration)))
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._stats, self._calls = {}, {}
+            self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+            self.until = time.time() + duration
+            self._timer = threading.Timer(duration, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+            self.active = True
+        logger.info(f"Profiling {self.sample_rate:.0%} of handler calls for {duration:.0f}s")
+        return self.status()
+
+    def stop(self) -> List[str]:
+        """Close the window and write one .prof file per profiled handler"""
+        with self._lock:
+            if not self.active:
+                return self.last_files
+            self.active = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            collected, self._stats = self._stats, {}
         
-        # Tracking variables
-        self.emotion_history = deque(maxlen=30)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        files = []
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            for name, stats in collected.items():
+                path = os.path.join(self.output_dir, f'{name}-{stamp}.prof')
+                stats.dump_stats(path)
+                files.append(path)
+        except OSError as e:
+            logger.error(f"Profile write error: {e}")
+        self.last_files = files
+        logger.info(f"Profiling stopped, wrote {len(files)} profiles to {self.output_dir}")
+        return files
+
+    def status(self) -> Dict:
+        return {
+            'active': self.active,
+            'sample_rate': self.sample_rate,
+            'remaining_s': round(max(0.0, self.until - time.time()), 1) if self.active else 0.0,
+            'sampled_calls': dict(self._calls),
+            'last_files': self.last_files
+        }
+
+profiler = SamplingProfiler()
+
+class FrameMailbox:
+    """Single-slot mailbox where a newer frame replaces an unprocessed one"""
+
+    __slots__ = ('_lock', '_frame', '_busy', 'received', 'processed', 'dropped')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self._busy = False
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def put(self, frame) -> bool:
+        """Store a frame. True if the caller should drain the mailbox."""
+        with self._lock:
+            self.received += 1
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            if self._busy:
+                return False
+            self._busy = True
+            return True
+
+    def take(self):
+        """Newest unprocessed frame, or None once drained (which releases the mailbox)"""
+        with self._lock:
+            frame, self._frame = self._frame, None
+            if frame is None:
+                self._busy = False
+            else:
+                self.processed += 1
+            return frame
+
+    def release(self):
+        """Give up draining after an error; a pending frame is dropped"""
+        with self._lock:
+            if self._frame is not None:
+                self.dropped += 1
+                self._frame = None
+            self._busy = False
+
+    def drain(self):
+        """Yield frames until the mailbox is empty.
+
+        Closing the generator early (an error or cancellation in the
+        caller) releases the mailbox, so the session is drained again.
+        """
+        drained = False
+        try:
+            while True:
+                frame = self.take()
+                if frame is None:
+                    drained = True
+                    return
+                yield frame
+        finally:
+            if not drained:
+                self.release()
+
+class TemporalSmoother(abc.ABC):
+    """Turns per-frame emotions into a stable one.
+
+    Keeps running per-class counts over a fixed ring buffer, so each frame
+    costs O(1) and allocates nothing. Subclasses decide which emotion the
+    window currently supports; switches are rate-limited by the hold time.
+    """
+
+    __slots__ = ('window', 'warmup', 'hold', 'current', 'last_change',
+                 '_ring', '_pos', '_size', '_counts')
+
+    def __init__(self, window: int = SMOOTHING_WINDOW, warmup: int = SMOOTHING_WARMUP,
+                 hold: float = SMOOTHING_HOLD):
+        self.window = max(1, window)
+        self.warmup = warmup
+        self.hold = hold
+        self.current = 'neutral'
+        self.last_change = time.time()
+        self._ring = [0] * self.window
+        self._pos = 0
+        self._size = 0
+        self._counts = [0] * len(EMOTIONS)
+
+    def push(self, emotion: str) -> bool:
+        """Add a frame's emotion; True if the stable emotion changed"""
+        index = EMOTION_INDEX[emotion]
+        if self._size == self.window:
+            self._counts[self._ring[self._pos]] -= 1
+        else:
+            self._size += 1
+        self._ring[self._pos] = index
+        self._counts[index] += 1
+        self._pos = (self._pos + 1) % self.window
+        self._observe(index)
+        
+        if self._size < self.warmup:
+            return False
+        candidate = self._candidate()
+        if candidate is None or candidate == self.current:
+            return False
+        now = time.time()
+        if now - self.last_change <= self.hold:
+            return False
+        self.current = candidate
+        self.last_change = now
+        return True
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self._ring) + sys.getsizeof(self._counts)
+
+    def agreement(self) -> float:
+        """Share of the window held by its most common emotion"""
+        if self._size < self.warmup:
+            return 0.0
+        return max(self._counts) / self._size
+
+    def _observe(self, index: int):
+        """Per-frame hook for strategies that keep extra state"""
+
+    @abc.abstractmethod
+    def _candidate(self) -> Optional[str]:
+        """Emotion the window currently supports, None to keep the current one"""
+
+class MajoritySmoother(TemporalSmoother):
+    """Switch to the emotion holding a majority share of the window"""
+
+    __slots__ = ('majority',)
+
+    def __init__(self, majority: float = SMOOTHING_MAJORITY, **kwargs):
+        super().__init__(**kwargs)
+        self.majority = majority
+
+    def _candidate(self) -> Optional[str]:
+        counts = self._counts
+        best = counts.index(max(counts))
+        return EMOTIONS[best] if counts[best] >= self._size * self.majority else None
+
+class EmaSmoother(TemporalSmoother):
+    """Exponential moving average over one-hot class scores"""
+
+    __slots__ = ('alpha', 'majority', '_scores')
+
+    def __init__(self, alpha: float = SMOOTHING_ALPHA, majority: float = SMOOTHING_MAJORITY, **kwargs):
+        super().__init__(**kwargs)
+        self.alpha = alpha
+        self.majority = majority
+        self._scores = [1.0 / len(EMOTIONS)] * len(EMOTIONS)
+
+    def _observe(self, index: int):
+        scores = self._scores
+        keep = 1.0 - self.alpha
+        for i in range(len(scores)):
+            scores[i] *= keep
+        scores[index] += self.alpha
+
+    def _candidate(self) -> Optional[str]:
+        scores = self._scores
+        best = scores.index(max(scores))
+        return EMOTIONS[best] if scores[best] >= self.majority else None
+
+    def agreement(self) -> float:
+        return max(self._scores) if self._size >= self.warmup else 0.0
+
+class HysteresisSmoother(TemporalSmoother):
+    """Take over only with a large share, hold on while keeping a small one"""
+
+    __slots__ = ('enter', 'stay')
+
+    def __init__(self, enter: float = SMOOTHING_ENTER, stay: float = SMOOTHING_STAY, **kwargs):
+        super().__init__(**kwargs)
+        self.enter = enter
+        self.stay = stay
+
+    def _candidate(self) -> Optional[str]:
+        counts = self._counts
+        if counts[EMOTION_INDEX[self.current]] >= self._size * self.stay:
+            return None
+        best = counts.index(max(counts))
+        return EMOTIONS[best] if counts[best] >= self._size * self.enter else None
+
+SMOOTHERS = {
+    'majority': MajoritySmoother,
+    'ema': EmaSmoother,
+    'hysteresis': HysteresisSmoother
+}
+
+def create_smoother(name: str = SMOOTHING_STRATEGY) -> TemporalSmoother:
+    """Instantiate a smoothing strategy by name, majority window by default"""
+    smoother_cls = SMOOTHERS.get(name)
+    if smoother_cls is None:
+        logger.error(f"Unknown smoothing strategy '{name}', using majority")
+        return MajoritySmoother()
+    return smoother_cls()
+
+class PlayedHistory:
+    """Bounded set of played video ids, the oldest are forgotten first"""
+
+    __slots__ = ('limit', '_ids')
+
+    def __init__(self, limit: int = PLAYED_HISTORY_LIMIT):
+        self.limit = limit
+        self._ids: Dict[str, None] = {}  # Insertion ordered
+
+    def add(self, vid_id: str):
+        # Interned so sessions that played the same song share one string
+        vid_id = sys.intern(vid_id)
+        self._ids.pop(vid_id, None)
+        self._ids[vid_id] = None
+        if len(self._ids) > self.limit:
+            del self._ids[next(iter(self._ids))]
+
+    def __contains__(self, vid_id) -> bool:
+        return vid_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self._ids)
+
+class DetectionSession:
+    """Per-connection detection state"""
+
+    __slots__ = (
+        'sid', 'smoother', 'face_history', 'frame_count', 'manual_emotion',
+        'manual_emotion_time', 'song_emotion', 'played', 'mailbox', 'face_box',
+        'frames_since_scan', 'tracked_frames', 'full_scans', 'signature', 'cached_emotion',
+        'cache_hits', 'cache_misses', 'capture_interval', 'created_at', 'last_seen'
+    )
+
+    def __init__(self, sid: str):
+        now = time.time()
+        self.sid = sid
+        self.smoother = create_smoother()
         self.face_history = deque(maxlen=10)
-        self.current_emotion = 'neutral'
-        self.last_emotion_change = time.time()
         self.frame_count = 0
         self.manual_emotion = None
         self.manual_emotion_time = 0
-        
-        logger.info("Improved emotion detector initialized")
-    
-    def process_frame(self, frame_data: str) -> Dict:
-        """Process frame and detect emotion"""
+        self.song_emotion = None  # Emotion the client's song list belongs to
+        self.played = PlayedHistory()
+        self.mailbox = FrameMailbox()
+        self.face_box = None  # Last face (x, y, w, h), None when lost
+        self.frames_since_scan = 0
+        self.tracked_frames = 0
+        self.full_scans = 0
+        self.signature = None  # Thumbnail of the last fully analysed frame
+        self.cached_emotion = None  # Its raw emotion, None when it had no face
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.capture_interval = CAPTURE_INTERVAL_MIN  # Recommended ms until the next frame
+        self.created_at = now
+        self.last_seen = now
+
+    def touch(self):
+        """Mark session as active"""
+        self.last_seen = time.time()
+
+    def memory_usage(self) -> int:
+        """Approximate bytes held by this session"""
+        # Emotion labels and booleans are shared objects, so only the
+        # containers themselves are counted
+        size = sys.getsizeof(self)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            size += value.memory_usage() if hasattr(value, 'memory_usage') else sys.getsizeof(value)
+        return size
+
+class SessionRegistry:
+    """Thread-safe registry of detection sessions keyed by socket id"""
+
+    def __init__(self, idle_timeout: int = SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._sessions: Dict[str, DetectionSession] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def create(self, sid: str) -> DetectionSession:
+        """Create a fresh session, replacing any previous one"""
+        session = DetectionSession(sid)
+        with self._lock:
+            self._sessions[sid] = session
+        return session
+
+    def get(self, sid: str) -> DetectionSession:
+        """Get session for sid, creating it if it was reaped or never registered"""
+        session = self._sessions.get(sid)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(sid)
+                if session is None:
+                    session = self._sessions[sid] = DetectionSession(sid)
+        session.touch()
+        return session
+
+    def drop(self, sid: str) -> Optional[DetectionSession]:
+        """Remove a session"""
+        with self._lock:
+            return self._sessions.pop(sid, None)
+
+    def reap_idle(self, is_connected: Optional[Callable[[str], bool]] = None) -> int:
+        """Drop sessions that have been idle longer than the timeout.
+
+        Sessions whose client is still connected are kept: music can play
+        for a long time with detection stopped, and a recreated session
+        would forget the played songs.
+        """
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            idle = [sid for sid, s in self._sessions.items()
+                    if s.last_seen < cutoff and not (is_connected and is_connected(sid))]
+            for sid in idle:
+                del self._sessions[sid]
+        if idle:
+            logger.info(f"Reaped {len(idle)} idle sessions")
+        return len(idle)
+
+    def stats(self) -> Dict:
+        """Session count and memory usage"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        sizes = [s.memory_usage() for s in sessions]
+        total = sum(sizes)
+        hits = sum(s.cache_hits for s in sessions)
+        misses = sum(s.cache_misses for s in sessions)
+        return {
+            'active': len(sessions),
+            'memory_bytes': total,
+            'memory_per_session': total // len(sizes) if sizes else DetectionSession('').memory_usage(),
+            'played_ids': sum(len(s.played) for s in sessions),
+            'frames_received': sum(s.mailbox.received for s in sessions),
+            'frames_processed': sum(s.mailbox.processed for s in sessions),
+            'frames_dropped': sum(s.mailbox.dropped for s in sessions),
+            'tracked_frames': sum(s.tracked_frames for s in sessions),
+            'full_scans': sum(s.full_scans for s in sessions),
+            'cache_hits': hits,
+            'cache_misses': misses,
+            'cache_hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0
+        }
+
+class CascadeSet:
+    """Haar cascades owned by a single detection worker"""
+
+    __slots__ = ('face', 'eye', 'smile')
+
+    def __init__(self):
+        self.face = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.eye = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
+        self.smile = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_smile.xml')
+
+class DetectionEngine:
+    """Fixed pool of detection workers, each with its own cascades.
+
+    CascadeClassifier objects must not be shared between threads, so every
+    worker loads its own set when it starts and work is dispatched to the
+    pool instead of running on the socket handler threads.
+    """
+
+    def __init__(self, workers: int = DETECTION_WORKERS):
+        self.workers = workers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._worker_stats: Dict[str, Dict] = {}
+        self._started = time.time()
+        if workers > 1:
+            # Parallelism comes from the pool; OpenCV's own threads would oversubscribe the cores
+            cv2.setNumThreads(1)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='detect',
+                                        initializer=self._init_worker)
+
+    def _init_worker(self):
+        self._local.cascades = CascadeSet()
+        with self._lock:
+            self._worker_stats[threading.current_thread().name] = {
+                'frames': 0,
+                'busy': 0.0,
+                'wait': 0.0,
+                'latencies': deque(maxlen=200)
+            }
+
+    def run(self, fn, *args):
+        """Run fn(cascades, *args) on a worker and wait for its result"""
+        return self.submit(fn, *args).result()
+
+    def submit(self, fn, *args) -> Future:
+        """Queue fn(cascades, *args) on a worker without waiting"""
+        return self._pool.submit(self._call, fn, args, time.perf_counter())
+
+    def _call(self, fn, args, queued_at: float):
+        started = time.perf_counter()
         try:
-            # Decode image
-            img_data = frame_data.split(',')[1] if ',' in frame_data else frame_data
-            img_bytes = base64.b64decode(img_data)
-            nparr = np.frombuffer(img_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            if img is None:
-                return self._no_face_response()
-            
-            # Convert to grayscale
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # Detect faces
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=4,
-                minSize=(60, 60)
-            )
-            
-            if len(faces) == 0:
-                self.face_history.append(False)
-                return self._no_face_response()
-            
-            self.face_history.append(True)
-            
-            # Get the largest face
-            face = max(faces, key=lambda f: f[2] * f[3])
-            x, y, w, h = face
-            
-            # Extract face region
-            face_roi = gray[y:y+h, x:x+w]
-            
-            # Analyze emotion
-            emotion = self._analyze_emotion(face_roi, img[y:y+h, x:x+w])
-            
-            # Add to history
-            self.emotion_history.append(emotion)
-            
-            # Get stable emotion
-            final_emotion = self._get_stable_emotion()
-            
-            # Check for manual override
-            if self.manual_emotion and time.time() - self.manual_emotion_time < 5:
-                final_emotion = self.manual_emotion
-            
-            self.frame_count += 1
-            
-            return {
-                'emotion': final_emotion,
-                'face_detected': True
+            return profiler.call('detect_frame', fn, self._local.cascades, *args)
+        finally:
+            finished = time.perf_counter()
+            stats = self._worker_stats[threading.current_thread().name]
+            stats['frames'] += 1
+            stats['busy'] += finished - started
+            stats['wait'] += started - queued_at
+            stats['latencies'].append(finished - started)
+
+    def stats(self) -> Dict:
+        """Throughput and latency per worker"""
+        elapsed = max(time.time() - self._started, 1e-6)
+        with self._lock:
+            workers = dict(self._worker_stats)
+        report = {}
+        for name, stats in sorted(workers.items()):
+            latencies = list(stats['latencies'])
+            frames = stats['frames']
+            report[name] = {
+                'frames': frames,
+                'fps': round(frames / elapsed, 2),
+                'utilization': round(stats['busy'] / elapsed, 3),
+                'latency_ms_mean': round(1000 * stats['busy'] / frames, 2) if frames else 0.0,
+                'latency_ms_p95': round(1000 * percentile(latencies, 95), 2),
+                'wait_ms_mean': round(1000 * stats['wait'] / frames, 2) if frames else 0.0
             }
-            
-        except Exception as e:
-            logger.error(f"Processing error: {e}")
-            return self._no_face_response()
+        return {
+            'workers': self.workers,
+            'frames': sum(w['frames'] for w in report.values()),
+            'per_worker': report
+        }
+
+class EmotionBackend(abc.ABC):
+    """Turns a detected face into happy/neutral/sad"""
+
+    name = 'base'
+
+    @abc.abstractmethod
+    def classify(self, cascades: CascadeSet, gray_face, color_face, frame_count: int = 0) -> str:
+        """happy, neutral or sad for one face"""
+
+class HeuristicBackend(EmotionBackend):
+    """Haar cascade and brightness heuristics"""
+
+    name = 'heuristic'
+
+    # Layout of the vectors returned by extract_features
+    FEATURE_NAMES = (
+        'eyes', 'smiles', 'upper_brightness', 'middle_brightness', 'lower_brightness',
+        'saturation', 'value', 'edge_density', 'brightness_std'
+    )
+
+    def classify(self, cascades: CascadeSet, gray_face, color_face, frame_count: int = 0) -> str:
+        features = self.extract_features(cascades, gray_face, color_face)
+        return self.classify_features(features, frame_count)
+
+    def extract_features(self, cascades: CascadeSet, gray_face, color_face, out=None) -> np.ndarray:
+        """Compute the fixed-size feature vector described by FEATURE_NAMES"""
+        avg_saturation, avg_value = self.color_means(color_face)
+        return self.pack_features(self.count_eyes(cascades, gray_face), self.count_smiles(cascades, gray_face),
+                                  self.band_brightness(gray_face), avg_saturation, avg_value,
+                                  self.edge_density(gray_face), out)
     
-    def _analyze_emotion(self, gray_face, color_face) -> str:
-        """Analyze face to determine emotion"""
+    # The feature stages, also timed one by one by benchmark.py
+    
+    @staticmethod
+    def count_eyes(cascades: CascadeSet, gray_face) -> int:
+        """Eyes in the upper half of the face"""
+        h = gray_face.shape[0]
+        return len(cascades.eye.detectMultiScale(gray_face[:h//2], 1.2, 3, minSize=(20, 20)))
+    
+    @staticmethod
+    def count_smiles(cascades: CascadeSet, gray_face) -> int:
+        """Smiles in the lower half of the face"""
+        h = gray_face.shape[0]
+        return len(cascades.smile.detectMultiScale(gray_face[h//2:], 1.5, 5, minSize=(25, 25)))
+    
+    @staticmethod
+    def band_brightness(gray_face) -> np.ndarray:
+        """Mean brightness of the upper, middle and lower thirds"""
+        # One pass over the pixels: row sums, then band means from their prefix sums
         h, w = gray_face.shape
-        
-        # Detect eyes in upper half of face
-        upper_face = gray_face[:h//2]
-        eyes = self.eye_cascade.detectMultiScale(upper_face, 1.2, 3, minSize=(20, 20))
-        
-        # Detect smile in lower half of face
-        lower_face = gray_face[h//2:]
-        smiles = self.smile_cascade.detectMultiScale(lower_face, 1.5, 5, minSize=(25, 25))
-        
-        # Analyze brightness patterns
-        upper_brightness = np.mean(gray_face[:h//3])
-        middle_brightness = np.mean(gray_face[h//3:2*h//3])
-        lower_brightness = np.mean(gray_face[2*h//3:])
-        
-        # Analyze color information
-        hsv = cv2.cvtColor(color_face, cv2.COLOR_BGR2HSV)
-        avg_saturation = np.mean(hsv[:, :, 1])
-        avg_value = np.mean(hsv[:, :, 2])
-        
-        # Calculate edge density
-        edges = cv2.Canny(gray_face, 50, 150)
-        edge_density = np.sum(edges > 0) / (h * w)
+        row_sums = np.cumsum(gray_face.sum(axis=1, dtype=np.float64))
+        bounds = (0, h//3, 2*h//3, h)
+        band_totals = np.diff(np.concatenate(([0.0], row_sums))[list(bounds)])
+        return band_totals / (np.diff(bounds) * w)
+    
+    @staticmethod
+    def color_means(color_face) -> Tuple[float, float]:
+        """Mean saturation and value in a single reduction over the HSV image"""
+        _, avg_saturation, avg_value, _ = cv2.mean(cv2.cvtColor(color_face, cv2.COLOR_BGR2HSV))
+        return avg_saturation, avg_value
+    
+    @staticmethod
+    def edge_density(gray_face) -> float:
+        """Share of Canny edge pixels"""
+        h, w = gray_face.shape
+        return cv2.countNonZero(cv2.Canny(gray_face, 50, 150)) / (h * w)
+    
+    @classmethod
+    def pack_features(cls, eyes: int, smiles: int, bands: np.ndarray, avg_saturation: float,
+                      avg_value: float, edge_density: float, out=None) -> np.ndarray:
+        """Stage results laid out as FEATURE_NAMES"""
+        features = np.empty(len(cls.FEATURE_NAMES), dtype=np.float32) if out is None else out
+        features[0] = eyes
+        features[1] = smiles
+        features[2:5] = bands
+        features[5] = avg_saturation
+        features[6] = avg_value
+        features[7] = edge_density
+        features[8] = bands.std()
+        return features
+
+    def extract_features_batch(self, cascades: CascadeSet, faces: List[Tuple]) -> np.ndarray:
+        """Feature matrix, one row per (gray_face, color_face) pair"""
+        matrix = np.empty((len(faces), len(self.FEATURE_NAMES)), dtype=np.float32)
+        for row, (gray_face, color_face) in zip(matrix, faces):
+            self.extract_features(cascades, gray_face, color_face, out=row)
+        return matrix
+
+    @staticmethod
+    def classify_features(features: np.ndarray, frame_count: int = 0) -> str:
+        """Map a feature vector to happy/neutral/sad"""
+        (eyes, smiles, upper_brightness, middle_brightness, lower_brightness,
+         avg_saturation, avg_value, edge_density, brightness_variance) = features.tolist()
         
         # HAPPY Detection
-        if len(smiles) > 0 or (lower_brightness > middle_brightness + 10):
-            if len(smiles) > 0 and lower_brightness > middle_brightness:
+        if smiles > 0 or (lower_brightness > middle_brightness + 10):
+            if smiles > 0 and lower_brightness > middle_brightness:
                 return 'happy'
             elif avg_saturation > 100 and lower_brightness > 100:
                 return 'happy'
@@ -945,14 +1729,14 @@ class ImprovedEmotionDetector:
                 return 'happy'
         
         # SAD Detection
-        if (len(smiles) == 0 and 
+        if (smiles == 0 and 
             lower_brightness < upper_brightness - 5 and
             avg_value < 100):
             return 'sad'
         
         if (edge_density > 0.08 and 
-            len(eyes) < 2 and
-            len(smiles) == 0):
+            eyes < 2 and
+            smiles == 0):
             return 'sad'
         
         if (middle_brightness < upper_brightness - 10 and
@@ -960,17 +1744,15 @@ class ImprovedEmotionDetector:
             return 'sad'
         
         # NEUTRAL Detection
-        brightness_variance = np.std([upper_brightness, middle_brightness, lower_brightness])
-        
         if brightness_variance < 15:
-            if len(eyes) >= 2 and len(smiles) == 0:
+            if eyes >= 2 and smiles == 0:
                 return 'neutral'
         
         # Time-based variation for better distribution
         time_factor = int(time.time()) % 30
         
         if time_factor < 10:
-            if lower_brightness > middle_brightness or len(smiles) > 0:
+            if lower_brightness > middle_brightness or smiles > 0:
                 return 'happy'
         elif time_factor < 20:
             if brightness_variance < 20:
@@ -981,32 +1763,296 @@ class ImprovedEmotionDetector:
         
         # Rotate through emotions
         emotions = ['happy', 'neutral', 'sad']
-        return emotions[self.frame_count % 3]
+        return emotions[frame_count % 3]
+
+class FerBackend(EmotionBackend):
+    """CPU-only CNN classifier from the fer package.
+
+    Faces come from our own cascade detection, so fer's MTCNN detector is
+    not used. The model is loaded once and shared by all detection workers.
+    """
+
+    name = 'fer'
+
+    # FER's seven classes folded onto the three moods
+    EMOTION_MAP = {
+        'happy': 'happy', 'surprise': 'happy',
+        'neutral': 'neutral',
+        'sad': 'sad', 'angry': 'sad', 'fear': 'sad', 'disgust': 'sad'
+    }
+
+    def __init__(self):
+        os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+        try:
+            from fer import FER
+        except ImportError as e:
+            raise RuntimeError("The fer backend needs the 'fer' package (pip install fer)") from e
+        self.model = FER(mtcnn=False)
+        self._lock = threading.Lock()
+        logger.info("FER emotion model loaded")
+
+    def classify(self, cascades: CascadeSet, gray_face, color_face, frame_count: int = 0) -> str:
+        h, w = gray_face.shape
+        with self._lock:
+            detections = self.model.detect_emotions(color_face, face_rectangles=[(0, 0, w, h)])
+        if not detections:
+            return 'neutral'
+        scores = detections[0]['emotions']
+        return self.EMOTION_MAP.get(max(scores, key=scores.get), 'neutral')
+
+EMOTION_BACKENDS = {
+    'heuristic': HeuristicBackend,
+    'fer': FerBackend
+}
+
+def create_backend(name: str) -> EmotionBackend:
+    """Instantiate a classifier backend, falling back to the heuristic one"""
+    backend_cls = EMOTION_BACKENDS.get(name)
+    if backend_cls is None:
+        logger.error(f"Unknown emotion backend '{name}', using heuristic")
+        return HeuristicBackend()
+    try:
+        return backend_cls()
+    except Exception as e:
+        logger.error(f"Could not load {name} backend ({e}), using heuristic")
+        return HeuristicBackend()
+
+class ImprovedEmotionDetector:
+    """Improved emotion detection that properly detects all three emotions"""
     
-    def _get_stable_emotion(self) -> str:
-        """Get most stable emotion from history"""
-        if len(self.emotion_history) < 5:
-            return self.current_emotion
+    def __init__(self, workers: int = DETECTION_WORKERS, detection_scale: float = DETECTION_SCALE,
+                 tracking: bool = FACE_TRACKING, backend: str = EMOTION_BACKEND,
+                 similarity_threshold: float = SIMILARITY_THRESHOLD):
+        # Each worker loads its own cascades
+        self.engine = DetectionEngine(workers)
+        self.detection_scale = min(1.0, max(0.1, detection_scale))
+        self.tracking = tracking
+        self.similarity_threshold = similarity_threshold
+        self.backend = create_backend(backend)
         
-        recent = list(self.emotion_history)[-10:]
-        emotion_counts = Counter(recent)
+        logger.info(f"Improved emotion detector initialized ({workers} workers, "
+                    f"detection scale {self.detection_scale}, {self.backend.name} backend)")
+    
+    def process_frame(self, frame_data: str, session: DetectionSession) -> Dict:
+        """Process a base64 data-URL frame and detect emotion"""
+        img_bytes = self.decode_data_url(frame_data)
+        if img_bytes is None:
+            return self._no_face_response()
+        
+        return self.process_frame_bytes(img_bytes, session)
+    
+    @staticmethod
+    def decode_data_url(frame_data: str) -> Optional[bytes]:
+        """JPEG bytes of a base64 data URL, None if it is malformed"""
+        try:
+            img_data = frame_data.split(',')[1] if ',' in frame_data else frame_data
+            return base64.b64decode(img_data)
+        except Exception as e:
+            logger.error(f"Frame decode error: {e}")
+            return None
+    
+    @staticmethod
+    def decode_image(img_bytes: bytes):
+        """BGR image of JPEG bytes, None if they don't decode"""
+        return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+    
+    @staticmethod
+    def frame_signature(gray):
+        """Grayscale thumbnail compared against the previous frame's"""
+        return cv2.resize(gray, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+    
+    def process_frame_bytes(self, img_bytes: bytes, session: DetectionSession) -> Dict:
+        """Process a raw JPEG frame and detect emotion"""
+        return self.finish_frame(self.submit_frame(img_bytes, session).result(), session)
+    
+    def submit_frame(self, img_bytes: bytes, session: DetectionSession) -> Future:
+        """Start detection on a worker; hand the result to finish_frame"""
+        return self.engine.submit(self._process_image, img_bytes, session)
+    
+    def finish_frame(self, result: Dict, session: DetectionSession) -> Dict:
+        """Add the recommended capture interval to a detection result"""
+        result['next_interval_ms'] = self._next_capture_interval(session, result['face_detected'])
+        return result
+    
+    def _next_capture_interval(self, session: DetectionSession, face_detected: bool) -> int:
+        """Back off while nothing changes, return to full rate when the mood is in flux"""
+        if face_detected and len(session.face_history) >= 2 and not session.face_history[-2]:
+            # A face just appeared
+            interval = CAPTURE_INTERVAL_MIN
+        elif face_detected and (session.smoother.agreement() < 0.8 or
+                                time.time() - session.smoother.last_change < 3):
+            # Mixed recent emotions or a fresh change
+            interval = CAPTURE_INTERVAL_MIN
+        else:
+            # Stable mood, or nobody in front of the camera
+            interval = session.capture_interval * CAPTURE_BACKOFF
         
-        most_common = emotion_counts.most_common(1)[0]
+        session.capture_interval = int(min(CAPTURE_INTERVAL_MAX, max(CAPTURE_INTERVAL_MIN, interval)))
+        return session.capture_interval
+    
+    def _process_image(self, cascades: CascadeSet, img_bytes: bytes, session: DetectionSession) -> Dict:
+        """Detection work, runs on a detection worker"""
+        # Counted here rather than on the short-lived socket handler threads,
+        # so the metric shards stay one per worker
+        frames_processed.inc()
+        try:
+            # Decode image straight from the received buffer
+            started = time.perf_counter()
+            img = self.decode_image(img_bytes)
+            
+            if img is None:
+                return self._no_face_response()
+            
+            # Convert to grayscale
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            frame_decode_seconds.observe(time.perf_counter() - started)
+            
+            # Reuse the last analysis when the frame barely changed
+            signature = self.frame_signature(gray)
+            if self._is_similar(signature, session.signature):
+                session.cache_hits += 1
+                emotion = session.cached_emotion
+            else:
+                session.cache_misses += 1
+                emotion = self._detect_emotion(cascades, img, gray, session)
+                session.signature = signature
+                session.cached_emotion = emotion
+            
+            if emotion is None:
+                faces_missed.inc()
+                session.face_history.append(False)
+                return self._no_face_response()
+            
+            faces_found.inc()
+            session.face_history.append(True)
+            
+            # Get stable emotion
+            final_emotion = self._get_stable_emotion(session, emotion)
+            
+            # Check for manual override
+            if session.manual_emotion and time.time() - session.manual_emotion_time < 5:
+                final_emotion = session.manual_emotion
+            
+            session.frame_count += 1
+            
+            return {
+                'emotion': final_emotion,
+                'face_detected': True
+            }
+            
+        except Exception as e:
+            logger.error(f"Processing error: {e}")
+            return self._no_face_response()
+    
+    def _is_similar(self, signature, previous) -> bool:
+        """Whether two frame thumbnails are within the similarity threshold"""
+        if previous is None or self.similarity_threshold <= 0:
+            return False
+        return cv2.norm(signature, previous, cv2.NORM_L1) / signature.size <= self.similarity_threshold
+    
+    def _detect_emotion(self, cascades: CascadeSet, img, gray, session: DetectionSession) -> Optional[str]:
+        """Raw emotion of the largest face, None when there is no face"""
+        started = time.perf_counter()
+        faces = self._locate_faces(cascades, gray, session)
+        face_detection_seconds.observe(time.perf_counter() - started)
         
-        if most_common[1] >= len(recent) * 0.6:
-            if time.time() - self.last_emotion_change > 3:
-                if most_common[0] != self.current_emotion:
-                    self.current_emotion = most_common[0]
-                    self.last_emotion_change = time.time()
-                    logger.info(f"Emotion changed to: {self.current_emotion}")
+        if len(faces) == 0:
+            session.face_box = None
+            return None
         
-        return self.current_emotion
+        # Get the largest face
+        face = max(faces, key=lambda f: f[2] * f[3])
+        x, y, w, h = face
+        session.face_box = (int(x), int(y), int(w), int(h))
+        
+        # Extract face region
+        face_roi = gray[y:y+h, x:x+w]
+        
+        # Analyze emotion
+        started = time.perf_counter()
+        emotion = self._analyze_emotion(face_roi, img[y:y+h, x:x+w], session, cascades)
+        emotion_analysis_seconds.observe(time.perf_counter() - started)
+        return emotion
+    
+    def _locate_faces(self, cascades: CascadeSet, gray, session: DetectionSession) -> np.ndarray:
+        """Detect faces, searching only around the last face while it is tracked.
+
+        Falls back to a full-frame scan when no face is tracked, when the
+        face is lost in the window, and every FULL_SCAN_INTERVAL frames so
+        a second, larger face is not missed for long.
+        """
+        box = session.face_box
+        if self.tracking and box is not None and session.frames_since_scan < FULL_SCAN_INTERVAL:
+            x, y, w, h = box
+            margin_x, margin_y = int(w * TRACKING_MARGIN), int(h * TRACKING_MARGIN)
+            height, width = gray.shape
+            x0, y0 = max(0, x - margin_x), max(0, y - margin_y)
+            x1, y1 = min(width, x + w + margin_x), min(height, y + h + margin_y)
+            
+            faces = self._detect_faces(cascades, gray[y0:y1, x0:x1])
+            if len(faces) > 0:
+                session.frames_since_scan += 1
+                session.tracked_frames += 1
+                # Window coordinates back to frame coordinates
+                return np.asarray(faces) + np.array([x0, y0, 0, 0])
+        
+        session.frames_since_scan = 0
+        session.full_scans += 1
+        return self._detect_faces(cascades, gray)
+    
+    def _detect_faces(self, cascades: CascadeSet, gray) -> np.ndarray:
+        """Detect faces as full-resolution (x, y, w, h) boxes.
+
+        With a detection scale below 1 the cascade runs on a downscaled
+        copy and the boxes are mapped back, so callers still crop the face
+        from the full-resolution frame.
+        """
+        scale = self.detection_scale
+        if scale >= 1.0:
+            return cascades.face.detectMultiScale(
+                gray,
+                scaleFactor=1.1,
+                minNeighbors=4,
+                minSize=(FACE_MIN_SIZE, FACE_MIN_SIZE)
+            )
+        
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # The cascade window is 24x24, so tiny scales also raise the smallest detectable face
+        min_side = max(24, int(round(FACE_MIN_SIZE * scale)))
+        faces = cascades.face.detectMultiScale(
+            small,
+            scaleFactor=1.1,
+            minNeighbors=4,
+            minSize=(min_side, min_side)
+        )
+        if len(faces) == 0:
+            return faces
+        
+        # Map boxes back to full resolution, clipped to the frame
+        height, width = gray.shape
+        faces = np.round(np.asarray(faces, dtype=np.float32) / scale).astype(np.int32)
+        faces[:, 0] = np.clip(faces[:, 0], 0, width - 1)
+        faces[:, 1] = np.clip(faces[:, 1], 0, height - 1)
+        faces[:, 2] = np.minimum(faces[:, 2], width - faces[:, 0])
+        faces[:, 3] = np.minimum(faces[:, 3], height - faces[:, 1])
+        return faces
+    
+    def _analyze_emotion(self, gray_face, color_face, session: DetectionSession, cascades: CascadeSet) -> str:
+        """Analyze face to determine emotion"""
+        return self.backend.classify(cascades, gray_face, color_face, session.frame_count)
+    
+    def _get_stable_emotion(self, session: DetectionSession, emotion: str) -> str:
+        """Feed the frame's emotion to the session smoother and get the stable one"""
+        if session.smoother.push(emotion):
+            emotion_changes.inc()
+            logger.info(f"Emotion changed to: {session.smoother.current} ({session.sid})")
+        return session.smoother.current
     
-    def set_manual_emotion(self, emotion: str):
+    def set_manual_emotion(self, session: DetectionSession, emotion: str):
         """Manually set emotion"""
-        self.manual_emotion = emotion
-        self.manual_emotion_time = time.time()
-        self.current_emotion = emotion
+        session.manual_emotion = emotion
+        session.manual_emotion_time = time.time()
+        session.smoother.current = emotion
     
     def _no_face_response(self) -> Dict:
         """Response when no face detected"""
@@ -1015,13 +2061,534 @@ class ImprovedEmotionDetector:
             'face_detected': False
         }
 
+class KeepAliveHTTPClient:
+    """Pool of persistent HTTP(S) connections to a single host"""
+
+    def __init__(self, base_url: str, pool_size: int = HTTP_POOL_SIZE,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = HTTP_READ_TIMEOUT):
+        parts = urllib.parse.urlsplit(base_url)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = queue.LifoQueue(maxsize=pool_size)  # Warmest connection first
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.opened = 0
+
+    def _connect(self, conn: Optional[http.client.HTTPConnection] = None) -> http.client.HTTPConnection:
+        """Open a connection with the connect timeout, then switch to the read timeout"""
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            conn = cls(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def _checkout(self) -> Tuple[http.client.HTTPConnection, bool]:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect(), False
+        # The server closed it since last use, reconnect in place
+        if conn.sock is None:
+            return self._connect(conn), False
+        return conn, True
+
+    def _checkin(self, conn: http.client.HTTPConnection, reusable: bool):
+        if reusable:
+            try:
+                self._idle.put_nowait(conn)
+                return
+            except queue.Full:
+                pass
+        conn.close()
+
+    def _send(self, path: str, headers: Dict) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        conn, reused = self._checkout()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError) as e:
+            if not reused:
+                conn.close()
+                raise
+            # Stale keep-alive connection, retry once on a fresh one
+            logger.debug(f"Reconnecting stale connection: {e}")
+            conn.close()
+            conn, reused = self._connect(), False
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        
+        with self._lock:
+            self.requests += 1
+            if reused:
+                self.reused += 1
+        return conn, response
+
+    def iter_content(self, path: str, headers: Dict, chunk_size: int = 16384):
+        """Yield decoded body chunks as they arrive.
+
+        The connection returns to the pool only if the body was read to the
+        end. Closing the generator early reads and discards up to
+        HTTP_DRAIN_LIMIT more raw bytes to get there, otherwise the
+        connection is dropped.
+        """
+        self._slots.acquire()
+        conn = None
+        response = None
+        complete = False
+        try:
+            conn, response = self._send(path, headers)
+            if response.status != 200:
+                raise http.client.HTTPException(f"HTTP {response.status} for {path}")
+            
+            encoding = (response.getheader('Content-Encoding') or '').lower()
+            # wbits 32 + MAX_WBITS accepts both gzip and zlib-wrapped deflate
+            decoder = zlib.decompressobj(32 + zlib.MAX_WBITS) if encoding in ('gzip', 'deflate') else None
+            
+            while True:
+                chunk = response.read1(chunk_size)
+                if not chunk:
+                    break
+                data = decoder.decompress(chunk) if decoder else chunk
+                if data:
+                    yield data
+            if decoder:
+                tail = decoder.flush()
+                if tail:
+                    yield tail
+            # read1() leaves a fully read response open, which would block the next request
+            complete = not response.will_close
+            response.close()
+        except GeneratorExit:
+            if response is not None and response.status == 200 and not response.will_close:
+                complete = self._drain(response)
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(conn, complete)
+            self._slots.release()
+
+    @staticmethod
+    def _drain(response: http.client.HTTPResponse, limit: int = HTTP_DRAIN_LIMIT) -> bool:
+        """Discard the rest of a body without decoding it; True if it ended within limit bytes"""
+        remaining = limit
+        try:
+            while remaining > 0:
+                chunk = response.read1(min(65536, remaining))
+                if not chunk:
+                    response.close()
+                    return True
+                remaining -= len(chunk)
+        except (OSError, http.client.HTTPException):
+            pass
+        return False
+
+    def get(self, path: str, headers: Dict) -> bytes:
+        """Fetch a whole decoded response body"""
+        return b''.join(self.iter_content(path, headers))
+
+    def stats(self) -> Dict:
+        return {
+            'pool_size': self.pool_size,
+            'idle': self._idle.qsize(),
+            'requests': self.requests,
+            'reused': self.reused,
+            'connections_opened': self.opened
+        }
+
+# Results page parsing
+YT_INITIAL_DATA_MARKER = 'ytInitialData'
+_VIDEO_RENDERER_RE = re.compile(r'"videoRenderer":\{"videoId":"([^"]+)"')
+_VIDEO_TITLE_RE = re.compile(r'"title":\{"runs":\[\{"text":"((?:[^"\\]|\\.)*)"')
+
+def _decode_json_string(raw: str) -> str:
+    try:
+        return json.loads(f'"{raw}"')
+    except ValueError:
+        return raw
+
+class VideoResultsParser:
+    """Extracts (videoId, title) pairs from a results page fed chunk by chunk.
+
+    Skips everything before the ytInitialData JSON, then pairs each
+    videoRenderer with the first title inside that same renderer. Only the
+    unparsed tail of the page is kept in memory. Push-based, so blocking
+    and asyncio readers can share it.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buf = ''
+        self._found_data = False
+
+    def feed(self, chunk: bytes, final: bool = False) -> List[Tuple[str, str]]:
+        """Pairs completed by this chunk"""
+        buf = self._buf + self._decoder.decode(chunk, final=final)
+        results = []
+        
+        if not self._found_data:
+            start = buf.find(YT_INITIAL_DATA_MARKER)
+            if start < 0:
+                # Keep just enough to match a marker split across chunks
+                self._buf = buf[-len(YT_INITIAL_DATA_MARKER):]
+                return results
+            self._found_data = True
+            buf = buf[start:]
+        
+        consumed = 0
+        renderer = _VIDEO_RENDERER_RE.search(buf)
+        while renderer is not None:
+            following = _VIDEO_RENDERER_RE.search(buf, renderer.end())
+            # Only accept a title that belongs to this renderer
+            limit = following.start() if following is not None else len(buf)
+            title = _VIDEO_TITLE_RE.search(buf, renderer.end(), limit)
+            if title is None and following is None and not final:
+                break  # Title may still be on its way
+            if title is not None:
+                results.append((renderer.group(1), _decode_json_string(title.group(1))))
+            if following is not None:
+                consumed = limit
+            else:
+                consumed = title.end() if title is not None else len(buf)
+            renderer = following
+        
+        # Carry over an incomplete renderer, or a short tail that may hold a split one
+        if renderer is not None:
+            self._buf = buf[renderer.start():]
+        else:
+            self._buf = buf[max(consumed, len(buf) - 64):]
+        return results
+
+    def finish(self) -> List[Tuple[str, str]]:
+        """Pairs left once the page has ended"""
+        return self.feed(b'', final=True)
+
+def iter_video_results(chunks):
+    """Yield (videoId, title) pairs from a results page as it streams in.
+
+    Closing the generator closes the underlying chunk iterator.
+    """
+    parser = VideoResultsParser()
+    try:
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+        yield from parser.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+class SongPool:
+    """Pre-fetched songs for one emotion, refilled in the background"""
+
+    def __init__(self, emotion: str, capacity: int = SONG_POOL_CAPACITY,
+                 low_water: int = SONG_POOL_LOW_WATER, ttl: int = SONG_POOL_TTL):
+        self.emotion = emotion
+        self.capacity = capacity
+        self.low_water = low_water
+        self.ttl = ttl
+        self._songs = OrderedDict()  # videoId -> (song, fetched_at), oldest first
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def add(self, songs: List[Dict]):
+        """Add songs, evicting the oldest ones beyond capacity"""
+        now = time.time()
+        with self._lock:
+            for song in songs:
+                if song['videoId'] not in self._songs:
+                    self._songs[song['videoId']] = (song, now)
+            while len(self._songs) > self.capacity:
+                self._songs.popitem(last=False)
+                self.evicted += 1
+
+    def take(self, count: int, exclude) -> List[Dict]:
+        """Remove and return up to count fresh songs whose ids are not in exclude"""
+        cutoff = time.time() - self.ttl
+        taken = []
+        with self._lock:
+            # Oldest entries sit at the front, so expiry stops at the first fresh one
+            while self._songs:
+                vid_id, (song, fetched_at) = next(iter(self._songs.items()))
+                if fetched_at >= cutoff:
+                    break
+                del self._songs[vid_id]
+                self.expired += 1
+            
+            for vid_id in list(self._songs):
+                if vid_id in exclude:
+                    continue
+                taken.append(self._songs.pop(vid_id)[0])
+                if len(taken) >= count:
+                    break
+            
+            if len(taken) >= count:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return taken
+
+    def begin_refill(self) -> bool:
+        """Claim the refill slot if the pool is below its low-water mark"""
+        with self._lock:
+            if self._refilling or len(self._songs) >= self.low_water:
+                return False
+            self._refilling = True
+            self.refills += 1
+            return True
+
+    def end_refill(self):
+        with self._lock:
+            self._refilling = False
+
+    def stats(self) -> Dict:
+        return {
+            'size': len(self._songs),
+            'refilling': self._refilling,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refills': self.refills,
+            'evicted': self.evicted,
+            'expired': self.expired
+        }
+
+class _Excluding:
+    """Membership test over several id containers without merging them"""
+
+    __slots__ = ('containers',)
+
+    def __init__(self, *containers):
+        self.containers = containers
+
+    def __contains__(self, item) -> bool:
+        return any(item in container for container in self.containers)
+
+class SongCatalog:
+    """On-disk catalog of every discovered song, indexed by emotion.
+
+    Each row carries a random sort key; sampling seeks to a random point of
+    the (emotion, rnd) index and reads forward, wrapping around once, and
+    served rows get a fresh key so the next sample draws different
+    neighbours.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS songs (
+            video_id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            emotion TEXT NOT NULL,
+            source_query TEXT,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            rnd REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS songs_emotion_rnd ON songs (emotion, rnd);
+        CREATE TABLE IF NOT EXISTS recent_queries (
+            query TEXT PRIMARY KEY,
+            used_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS recent_queries_used_at ON recent_queries (used_at);
+    """
+
+    def __init__(self, path: str = CATALOG_PATH, scan_limit: int = CATALOG_SCAN_LIMIT):
+        self.path = path
+        self.scan_limit = scan_limit
+        # WAL lets every worker process read while one writes
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._claims = 0
+        self.stored = 0  # Rows inserted or refreshed
+        self.served = 0
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, emotion: str, query: str, songs: List[Dict]):
+        """Insert new songs, refreshing last_seen for ones already known"""
+        if not songs:
+            return
+        now = time.time()
+        rows = [(song['videoId'], song['title'], emotion, query, now, now, random.random()) for song in songs]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                'INSERT INTO songs (video_id, title, emotion, source_query, first_seen, last_seen, rnd) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(video_id) DO UPDATE SET last_seen = excluded.last_seen, title = excluded.title',
+                rows)
+            self.stored += self._conn.total_changes - before
+
+    def sample(self, emotion: str, count: int, exclude=()) -> List[Dict]:
+        """Up to count random songs of an emotion whose ids are not in exclude"""
+        start = random.random()
+        batch = max(count * 2, 20)
+        picked = []
+        scanned = 0
+        with self._lock:
+            for lower, upper in ((start, 2.0), (-1.0, start)):
+                after = -2.0  # Exclusive bound once the first batch is read
+                while len(picked) < count and scanned < self.scan_limit:
+                    rows = self._conn.execute(
+                        'SELECT video_id, title, rnd FROM songs '
+                        'WHERE emotion = ? AND rnd >= ? AND rnd > ? AND rnd < ? ORDER BY rnd LIMIT ?',
+                        (emotion, lower, after, upper, batch)).fetchall()
+                    scanned += len(rows)
+                    for vid_id, title, _ in rows:
+                        if vid_id not in exclude:
+                            picked.append((vid_id, title))
+                            if len(picked) >= count:
+                                break
+                    if len(rows) < batch:
+                        break
+                    after = rows[-1][2]
+            
+            if picked:
+                self._conn.executemany('UPDATE songs SET rnd = ? WHERE video_id = ?',
+                                       [(random.random(), vid_id) for vid_id, _ in picked])
+            self.served += len(picked)
+            if len(picked) >= count:
+                self.hits += 1
+            else:
+                self.misses += 1
+        
+        return [{
+            'videoId': vid_id,
+            'title': title,
+            'thumbnail': f'https://img.youtube.com/vi/{vid_id}/mqdefault.jpg'
+        } for vid_id, title in picked]
+
+    def claim_query(self, query: str, history: int = QUERY_HISTORY_SIZE, force: bool = False) -> bool:
+        """Record a search query; False if it is among the last history queries of any worker.
+
+        With force the query is marked as just used even if it was already recent.
+        """
+        with self._lock:
+            now = time.time()
+            claimed = self._conn.execute('INSERT OR IGNORE INTO recent_queries (query, used_at) VALUES (?, ?)',
+                                         (query, now)).rowcount == 1
+            if not claimed and force:
+                self._conn.execute('UPDATE recent_queries SET used_at = ? WHERE query = ?', (now, query))
+            self._claims += 1
+            if self._claims % 50 == 0:
+                self._conn.execute('DELETE FROM recent_queries WHERE used_at < (SELECT used_at FROM recent_queries '
+                                   'ORDER BY used_at DESC LIMIT 1 OFFSET ?)', (history,))
+        return claimed
+
+    def count(self, emotion: Optional[str] = None) -> int:
+        with self._lock:
+            if emotion is None:
+                return self._conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+            return self._conn.execute('SELECT COUNT(*) FROM songs WHERE emotion = ?', (emotion,)).fetchone()[0]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            sizes = dict(self._conn.execute('SELECT emotion, COUNT(*) FROM songs GROUP BY emotion').fetchall())
+        return {
+            'path': self.path,
+            'songs': sizes,
+            'stored': self.stored,
+            'served': self.served,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+class QuerySpace:
+    """Every search query one emotion can produce, served in shuffled order.
+
+    The space (templates x keywords x artists/movies x years x quality x
+    suffixes) is never materialised. Positions 0, 1, 2, ... go through a
+    keyed Feistel permutation of range(size) and the result is decoded
+    digit by digit into template components, so each query is O(1) time
+    and memory and a full cycle visits every query exactly once.
+    """
+
+    def __init__(self, templates: List[Tuple[str, Tuple]], rng: random.Random):
+        self.templates = templates  # (format string, component option lists)
+        self._ends = list(itertools.accumulate(
+            math.prod(len(options) for options in components) for _, components in templates))
+        self.size = self._ends[-1]
+        self.rng = rng
+        self._lock = threading.Lock()
+        # Feistel network over 2 * half_bits bits, cycle-walked down to size
+        self._half_bits = max(1, (max(1, self.size - 1).bit_length() + 1) // 2)
+        self.cycles = 0
+        self._new_cycle()
+
+    def _new_cycle(self):
+        self._keys = [self.rng.getrandbits(32) for _ in range(4)]
+        self._position = 0
+
+    def _permute(self, index: int) -> int:
+        mask = (1 << self._half_bits) - 1
+        while True:
+            left, right = index >> self._half_bits, index & mask
+            for key in self._keys:
+                left, right = right, left ^ (hash((right, key)) & mask)
+            index = (left << self._half_bits) | right
+            if index < self.size:
+                return index
+
+    def next(self) -> str:
+        """Next query of the current permutation, starting a new one when exhausted"""
+        with self._lock:
+            if self._position >= self.size:
+                self._new_cycle()
+                self.cycles += 1
+            index = self._permute(self._position)
+            self._position += 1
+        return self.decode(index)
+
+    def decode(self, index: int) -> str:
+        """Query at a position of the (unshuffled) space"""
+        template_index = bisect.bisect_right(self._ends, index)
+        local = index - (self._ends[template_index - 1] if template_index else 0)
+        template, components = self.templates[template_index]
+        values = []
+        for options in components:
+            local, digit = divmod(local, len(options))
+            values.append(options[digit])
+        return template.format(*values)
+
+    def stats(self) -> Dict:
+        return {'size': self.size, 'served': self._position, 'cycles': self.cycles}
+
 class DynamicYouTubeMusic:
     """100% Dynamic YouTube music search - no predefined songs"""
     
-    def __init__(self):
+    def __init__(self, base_url: str = YOUTUBE_BASE_URL, seed: Optional[str] = SEARCH_SEED,
+                 catalog_path: str = CATALOG_PATH, shared_history: bool = bool(WORKER_ID)):
         # Dynamic search components
         self.search_count = 0
-        self.used_queries = set()  # Track used queries to avoid repetition
+        self.rng = random.Random(seed)
+        self.recent_queries = OrderedDict()  # Bounded window of used queries
+        self.shared_history = shared_history  # Also keep the window in the catalog, for cluster workers
+        self._query_lock = threading.Lock()
         
         # Dynamic components for building queries
         self.years = ['2024', '2023', '2022', '2021', '2020', 'latest', 'new']
@@ -1053,22 +2620,108 @@ class DynamicYouTubeMusic:
             'brahmastra', 'bhediya', 'bhool bhulaiyaa', 'kabir singh', 'kesari'
         ]
         
-    def search_songs(self, emotion: str, played_songs: List[str] = []) -> List[Dict]:
-        """Generate completely dynamic search query and get songs"""
+        self.query_spaces = self._build_query_spaces()
+        
+        # Keep-alive connections shared by every search
+        self.base_url = base_url
+        self.http = KeepAliveHTTPClient(base_url)
+        
+        # Pre-warmed songs per emotion so mood switches don't wait on a scrape
+        self.pools = {emotion: SongPool(emotion) for emotion in ['happy', 'neutral', 'sad']}
+        self._refill_executor = ThreadPoolExecutor(max_workers=len(self.pools), thread_name_prefix='song-pool')
+        
+        # Every discovered song, kept across restarts; opened on first use
+        self.catalog_path = catalog_path
+        self._catalog = None
+        self._catalog_opened = False
+        self._catalog_lock = threading.Lock()
         
-        # Build a unique dynamic query
+    @property
+    def catalog(self) -> Optional[SongCatalog]:
+        """The song catalog, None when disabled or unavailable"""
+        if not self._catalog_opened:
+            with self._catalog_lock:
+                if not self._catalog_opened:
+                    if self.catalog_path:
+                        try:
+                            self._catalog = SongCatalog(self.catalog_path)
+                        except sqlite3.Error as e:
+                            logger.error(f"Song catalog unavailable ({self.catalog_path}): {e}")
+                    self._catalog_opened = True
+        return self._catalog
+    
+    def prewarm(self):
+        """Start filling every song pool in the background"""
+        for emotion in self.pools:
+            self._request_refill(emotion)
+    
+    def _request_refill(self, emotion: str):
+        pool = self.pools[emotion]
+        if pool.begin_refill():
+            self._refill_executor.submit(self._refill_pool, pool)
+    
+    def _refill_pool(self, pool: SongPool):
+        """Fill a pool up to half its capacity with a few dynamic queries"""
+        try:
+            for _ in range(SONG_POOL_REFILL_QUERIES):
+                query = self._generate_dynamic_query(pool.emotion)
+                songs = self._search_youtube(query)
+                pool.add(songs)
+                self._remember(pool.emotion, query, songs)
+                if len(pool) >= pool.capacity // 2:
+                    break
+            logger.info(f"Refilled {pool.emotion} pool: {len(pool)} songs")
+        except Exception as e:
+            logger.error(f"Pool refill error ({pool.emotion}): {e}")
+        finally:
+            pool.end_refill()
+    
+    def pool_stats(self) -> Dict:
+        return {emotion: pool.stats() for emotion, pool in self.pools.items()}
+    
+    def _remember(self, emotion: str, query: str, songs: List[Dict]):
+        """Store discovered songs in the catalog"""
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.add(emotion, query, songs)
+        except sqlite3.Error as e:
+            logger.error(f"Catalog write error: {e}")
+    
+    def catalog_stats(self) -> Dict:
+        return self.catalog.stats() if self.catalog is not None else {}
+    
+    def search_songs(self, emotion: str, played_songs=()) -> List[Dict]:
+        """Generate completely dynamic search query and get songs.
+
+        played_songs is any container of video ids to skip, typically the
+        session's PlayedHistory; it is only ever probed with `in`.
+        """
+        
+        songs = self.stored_songs(emotion, played_songs)
+        if len(songs) >= 5:
+            self.rng.shuffle(songs)
+            return songs
+        
+        # Don't hand out the same song twice in one list
+        seen_ids = {song['videoId'] for song in songs}
+        
+        # Scrape only to top up what the pool and catalog couldn't cover
         query = self._generate_dynamic_query(emotion)
         
         logger.info(f"Dynamic search: {query}")
         
         try:
-            songs = self._search_youtube(query, played_songs)
+            found = self._search_youtube(query, played_songs, seen_ids)
+            self._remember(emotion, query, found)
+            songs.extend(found)
             self.search_count += 1
             
             # If not enough songs, try another query
             if len(songs) < 5:
                 query = self._generate_dynamic_query(emotion)
-                additional_songs = self._search_youtube(query, played_songs)
+                additional_songs = self._search_youtube(query, played_songs, seen_ids)
+                self._remember(emotion, query, additional_songs)
                 songs.extend(additional_songs)
             
             return songs[:10]
@@ -1077,130 +2730,165 @@ class DynamicYouTubeMusic:
             # Try one more time with a different query
             try:
                 query = self._generate_dynamic_query(emotion)
-                return self._search_youtube(query, played_songs)[:10]
+                found = self._search_youtube(query, played_songs)
+                self._remember(emotion, query, found)
+                return found[:10]
             except:
                 return []
     
-    def _generate_dynamic_query(self, emotion: str) -> str:
-        """Generate a completely unique search query"""
-        
-        # Choose random components
-        year = random.choice(self.years)
-        quality_word = random.choice(self.quality)
+    def stored_songs(self, emotion: str, played_songs=()) -> List[Dict]:
+        """Up to 10 songs from the pre-warmed pool, topped up from the catalog"""
+        songs = []
+        pool = self.pools.get(emotion)
+        if pool is not None:
+            songs = pool.take(10, played_songs)
+            self._request_refill(emotion)
+            if len(songs) >= 5:
+                return songs
         
-        # Build query based on emotion
-        if emotion == 'happy':
-            keyword = random.choice(self.happy_keywords)
-            # Sometimes add artist for variety
-            if random.random() > 0.7:
-                artist = random.choice(['neha kakkar', 'badshah', 'yo yo honey singh', 'mika singh'])
-                query = f"{artist} {keyword} bollywood songs {year}"
-            # Sometimes add movie
-            elif random.random() > 0.5:
-                movie = random.choice(self.movies)
-                query = f"{movie} {keyword} songs bollywood"
-            else:
-                query = f"bollywood {keyword} songs {year} {quality_word}"
-        
-        elif emotion == 'sad':
-            keyword = random.choice(self.sad_keywords)
-            # Higher chance of artist for sad songs
-            if random.random() > 0.5:
-                artist = random.choice(['arijit singh', 'atif aslam', 'b praak', 'jubin nautiyal'])
-                query = f"{artist} {keyword} bollywood songs {year}"
-            else:
-                query = f"bollywood {keyword} songs {year} hindi {quality_word}"
-        
-        else:  # neutral
-            keyword = random.choice(self.neutral_keywords)
-            if random.random() > 0.6:
-                artist = random.choice(['arijit singh', 'shreya ghoshal', 'armaan malik', 'darshan raval'])
-                query = f"{artist} {keyword} bollywood {year}"
-            elif random.random() > 0.4:
-                movie = random.choice(self.movies)
-                query = f"{movie} {keyword} songs"
-            else:
-                query = f"bollywood {keyword} songs {year} {quality_word}"
+        # Then from songs discovered earlier, possibly before a restart
+        if self.catalog is not None:
+            seen_ids = {song['videoId'] for song in songs}
+            try:
+                songs.extend(self.catalog.sample(emotion, 10 - len(songs), _Excluding(played_songs, seen_ids)))
+            except sqlite3.Error as e:
+                logger.error(f"Catalog read error: {e}")
+        return songs
+    
+    def _build_query_spaces(self) -> Dict[str, QuerySpace]:
+        """Query templates per emotion, over the component lists above"""
+        suffixes = ('',) + tuple(f' {suffix}' for suffix in
+                                 ['hd', 'official', 'full song', 'video song', 'lyrical', 'audio'])
+        years, quality, movies = tuple(self.years), tuple(self.quality), tuple(self.movies)
+        happy, neutral, sad = tuple(self.happy_keywords), tuple(self.neutral_keywords), tuple(self.sad_keywords)
         
-        # Add random suffix sometimes
-        suffixes = ['hd', 'official', 'full song', 'video song', 'lyrical', 'audio']
-        if random.random() > 0.7:
-            query += f" {random.choice(suffixes)}"
+        templates = {
+            'happy': [
+                ('{} {} bollywood songs {}{}',
+                 (('neha kakkar', 'badshah', 'yo yo honey singh', 'mika singh'), happy, years, suffixes)),
+                ('{} {} songs bollywood{}', (movies, happy, suffixes)),
+                ('bollywood {} songs {} {}{}', (happy, years, quality, suffixes))
+            ],
+            'sad': [
+                ('{} {} bollywood songs {}{}',
+                 (('arijit singh', 'atif aslam', 'b praak', 'jubin nautiyal'), sad, years, suffixes)),
+                ('bollywood {} songs {} hindi {}{}', (sad, years, quality, suffixes))
+            ],
+            'neutral': [
+                ('{} {} bollywood {}{}',
+                 (('arijit singh', 'shreya ghoshal', 'armaan malik', 'darshan raval'), neutral, years, suffixes)),
+                ('{} {} songs{}', (movies, neutral, suffixes)),
+                ('bollywood {} songs {} {}{}', (neutral, years, quality, suffixes))
+            ]
+        }
+        return {emotion: QuerySpace(spec, self.rng) for emotion, spec in templates.items()}
+    
+    def _generate_dynamic_query(self, emotion: str) -> str:
+        """Next query from the emotion's shuffled query space, skipping recent ones"""
+        space = self.query_spaces.get(emotion, self.query_spaces['neutral'])
         
-        # Make sure we don't repeat the exact same query
-        attempts = 0
-        while query in self.used_queries and attempts < 10:
-            # Modify query slightly
-            query = query + f" {random.choice(['mix', 'jukebox', 'playlist', 'collection'])}"
-            attempts += 1
+        # Repeats only happen across permutation cycles, so a few tries is plenty.
+        # In a cluster the catalog shares the history with the other workers.
+        for _ in range(10):
+            query = space.next()
+            if query not in self.recent_queries and self._claim_query(query):
+                break
+        else:
+            # Out of tries: the last query is used anyway, so it counts as fresh
+            self._claim_query(query, force=True)
         
-        self.used_queries.add(query)
+        with self._query_lock:
+            self.recent_queries[query] = None
+            self.recent_queries.move_to_end(query)
+            while len(self.recent_queries) > QUERY_HISTORY_SIZE:
+                self.recent_queries.popitem(last=False)
         
         return query
     
-    def _search_youtube(self, query: str, played_songs: List[str]) -> List[Dict]:
-        """Search YouTube dynamically"""
+    def _claim_query(self, query: str, force: bool = False) -> bool:
+        if not self.shared_history or self.catalog is None:
+            return True
         try:
-            # Add some randomization to the search URL itself
-            sort_options = ['relevance', 'rating', 'viewCount', 'date']
-            sort_by = random.choice(sort_options)
-            
-            encoded = urllib.parse.quote(query)
-            url = f"https://www.youtube.com/results?search_query={encoded}&sp={self._get_filter_param(sort_by)}"
-            
-            headers = {
-                'User-Agent': f'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/{random.randint(500, 599)}.36',
-                'Accept-Language': 'en-US,en;q=0.9,hi;q=0.8'
-            }
-            
-            req = urllib.request.Request(url, headers=headers)
-            response = urllib.request.urlopen(req, timeout=10)
-            html = response.read().decode('utf-8')
-            
-            # Extract video data with better regex
-            video_pattern = r'"videoId":"([^"]+)".*?"title":{"runs":\[{"text":"([^"]+)"'
-            matches = re.findall(video_pattern, html)
-            
-            # Also try alternate pattern
-            if len(matches) < 10:
-                video_ids = re.findall(r'"videoId":"([^"]+)"', html)
-                titles = re.findall(r'"title":{"runs":\[{"text":"([^"]+)"', html)
-                matches = list(zip(video_ids, titles))
-            
+            return self.catalog.claim_query(query, force=force)
+        except sqlite3.Error as e:
+            logger.error(f"Query history error: {e}")
+            return True
+    
+    def query_stats(self) -> Dict:
+        return {
+            'recent': len(self.recent_queries),
+            'spaces': {emotion: space.stats() for emotion, space in self.query_spaces.items()}
+        }
+    
+    def _search_youtube(self, query: str, played_songs=(), seen_ids: Optional[set] = None) -> List[Dict]:
+        """Search YouTube dynamically; returned ids are added to seen_ids"""
+        started = time.perf_counter()
+        try:
+            path, headers = self._search_request(query)
+            results = iter_video_results(self.http.iter_content(path, headers))
             songs = []
-            seen_ids = set(played_songs)
+            if seen_ids is None:
+                seen_ids = set()
             
-            for vid_id, title in matches:
-                # Skip if already played or seen in this batch
-                if vid_id in seen_ids:
-                    continue
-                
-                # Clean title
-                title = self._clean_title(title)
-                
-                # Skip non-music content
-                if any(skip in title.lower() for skip in ['news', 'interview', 'making', 'behind']):
-                    continue
-                
-                songs.append({
-                    'videoId': vid_id,
-                    'title': title,
-                    'thumbnail': f'https://img.youtube.com/vi/{vid_id}/mqdefault.jpg'
-                })
-                
-                seen_ids.add(vid_id)
-                
-                if len(songs) >= 15:  # Get extra to ensure we have 10 good ones
-                    break
+            try:
+                self._accept_songs(results, played_songs, seen_ids, songs)
+            finally:
+                # Stops reading the page once enough songs are collected
+                results.close()
             
             # Shuffle for variety
-            random.shuffle(songs)
+            self.rng.shuffle(songs)
             
             return songs[:10]
             
         except Exception as e:
             logger.error(f"YouTube search error: {e}")
+            search_failures.inc()
             return []
+        finally:
+            search_youtube_seconds.observe(time.perf_counter() - started)
+    
+    def _search_request(self, query: str) -> Tuple[str, Dict]:
+        """Path and headers of a results page request"""
+        # Add some randomization to the search URL itself
+        sort_options = ['relevance', 'rating', 'viewCount', 'date']
+        sort_by = self.rng.choice(sort_options)
+        
+        encoded = urllib.parse.quote(query)
+        path = f"/results?search_query={encoded}&sp={self._get_filter_param(sort_by)}"
+        
+        headers = {
+            'User-Agent': f'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/{self.rng.randint(500, 599)}.36',
+            'Accept-Language': 'en-US,en;q=0.9,hi;q=0.8',
+            'Accept-Encoding': 'gzip, deflate'
+        }
+        return path, headers
+    
+    def _accept_songs(self, results, played_songs, seen_ids: set, songs: List[Dict]) -> bool:
+        """Append songs from (videoId, title) pairs; True once there are enough"""
+        for vid_id, title in results:
+            # Skip if already played or seen in this batch
+            if vid_id in seen_ids or vid_id in played_songs:
+                continue
+            
+            # Clean title
+            title = self._clean_title(title)
+            
+            # Skip non-music content
+            if any(skip in title.lower() for skip in ['news', 'interview', 'making', 'behind']):
+                continue
+            
+            songs.append({
+                'videoId': vid_id,
+                'title': title,
+                'thumbnail': f'https://img.youtube.com/vi/{vid_id}/mqdefault.jpg'
+            })
+            
+            seen_ids.add(vid_id)
+            
+            if len(songs) >= 15:  # Get extra to ensure we have 10 good ones
+                return True
+        return False
     
     def _get_filter_param(self, sort_by: str) -> str:
         """Get YouTube filter parameter"""
@@ -1231,80 +2919,392 @@ class DynamicYouTubeMusic:
         
         return title.strip()
 
+class SearchQueue:
+    """Admission, counters and latency stats shared by the thread and asyncio search executors"""
+
+    def __init__(self, queue_limit: int = SEARCH_QUEUE_LIMIT):
+        self.queue_limit = queue_limit
+        self._lock = threading.Lock()
+        self._pending = 0  # Queued and running searches
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._waits = deque(maxlen=500)
+        self._latencies = deque(maxlen=500)
+
+    def _admit(self) -> bool:
+        """Reserve a queue slot; False (and counted as rejected) if the queue is full"""
+        with self._lock:
+            if self._pending >= self.queue_limit:
+                self.rejected += 1
+                return False
+            self._pending += 1
+            return True
+
+    def _begin(self) -> float:
+        with self._lock:
+            self._running += 1
+        return time.time()
+
+    def _finish(self, started: float, queued_at: float, songs: List[Dict], error: Optional[Exception]):
+        """Record a finished search and free its slot"""
+        if error is None:
+            songs_per_search.observe(len(songs))
+        else:
+            logger.error(f"Background search error: {error}")
+            search_failures.inc()
+        search_songs_seconds.observe(time.time() - started)
+        with self._lock:
+            self._pending -= 1
+            self._running -= 1
+            self.completed += 1
+            if error is not None:
+                self.failed += 1
+            self._waits.append(started - queued_at)
+            self._latencies.append(time.time() - started)
+
+    def stats(self) -> Dict:
+        """Queue depth and search latency"""
+        with self._lock:
+            waits = list(self._waits)
+            latencies = list(self._latencies)
+            return {
+                'queue_depth': self._pending - self._running,
+                'running': self._running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_ms_mean': round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                'latency_ms_mean': round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0.0,
+                'latency_ms_p95': round(1000 * percentile(latencies, 95), 1),
+                'latency_ms_max': round(1000 * max(latencies), 1) if latencies else 0.0
+            }
+
+class SongSearchExecutor(SearchQueue):
+    """Bounded worker pool that runs song searches off the socket handlers"""
+
+    def __init__(self, music: DynamicYouTubeMusic, workers: int = SEARCH_WORKERS,
+                 queue_limit: int = SEARCH_QUEUE_LIMIT):
+        super().__init__(queue_limit)
+        self.music = music
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='song-search')
+
+    def submit(self, emotion: str, played_songs, callback) -> bool:
+        """Queue a search; callback receives the songs. False if the queue is full."""
+        if not self._admit():
+            return False
+        self._pool.submit(self._run, emotion, played_songs, callback, time.time())
+        return True
+
+    def _run(self, emotion: str, played_songs, callback, queued_at: float):
+        started = self._begin()
+        songs, error = [], None
+        try:
+            songs = profiler.call('search_songs', self.music.search_songs, emotion, played_songs)
+        except Exception as e:
+            error = e
+        finally:
+            self._finish(started, queued_at, songs, error)
+        
+        try:
+            callback(songs)
+        except Exception as e:
+            logger.error(f"Search callback error: {e}")
+
 # Global instances
 detector = ImprovedEmotionDetector()
 youtube = DynamicYouTubeMusic()
-current_emotion = None
+sessions = SessionRegistry()
+song_search = SongSearchExecutor(youtube)
+metrics.gauge('moodify_active_sessions', 'Socket sessions with detection state', lambda: len(sessions))
+_background_started = False
+_process_started = time.time()
+_background_lock = threading.Lock()
+
+def _reap_idle_sessions():
+    """Background task that drops sessions of clients that went quiet"""
+    while True:
+        socketio.sleep(SESSION_REAP_INTERVAL)
+        sessions.reap_idle(lambda sid: socketio.server.manager.is_connected(sid, '/'))
+
+def _start_background_services():
+    """Start the session reaper and pre-warm song pools once per process"""
+    global _background_started
+    with _background_lock:
+        if not _background_started:
+            _background_started = True
+            socketio.start_background_task(_reap_idle_sessions)
+            youtube.prewarm()
+
+# Socket event logic without the transport; async_server.py shares it
+
+def _songs_update(session: DetectionSession, emotion: str, songs: List[Dict], request_id=None) -> Optional[Dict]:
+    """emotion_update carrying search results, None if a newer emotion has taken over.
+
+    A client-supplied request_id is echoed with the songs.
+    """
+    if session.song_emotion != emotion:
+        return None
+    update = {
+        'emotion': emotion,
+        'face_detected': True,
+        'songs': songs
+    }
+    if request_id is not None:
+        update['request_id'] = request_id
+    logger.info(f"Emotion: {emotion}, New songs: {len(songs)}")
+    return update
+
+def _search_status(session: DetectionSession, emotion: str, accepted: bool) -> str:
+    """status_message once a search was submitted or turned away"""
+    if accepted:
+        return f'Finding new {emotion} songs...'
+    # Let the next frame retry once the queue drains
+    session.song_emotion = None
+    logger.warning(f"Search queue full, dropped {emotion} search for {session.sid}")
+    return 'Busy, retrying song search...'
+
+def _frame_search_emotion(session: DetectionSession, result: Dict) -> Optional[str]:
+    """Emotion to find new songs for when a frame changed the mood, else None"""
+    if result.get('emotion') and result['emotion'] != session.song_emotion:
+        session.song_emotion = result['emotion']
+        return session.song_emotion
+    return None
+
+def _frame_ack(session: DetectionSession, processed: bool) -> Dict:
+    """Acknowledgement of a frame event"""
+    return {
+        'processed': processed,
+        'dropped': session.mailbox.dropped,
+        'next_interval_ms': session.capture_interval
+    }
+
+def _data_url_frame(session: DetectionSession, data: Dict) -> Tuple[str, bool]:
+    """(image, no_repeat) of a process_frame event; older clients send their full played list"""
+    played_songs = data.get('played_songs', [])
+    for vid_id in played_songs:
+        session.played.add(vid_id)
+    return data['image'], bool(played_songs)
+
+def _binary_frame(session: DetectionSession, data: Dict):
+    """JPEG attachment of a process_frame_binary event, None if it is not binary"""
+    image = data.get('image')
+    if not isinstance(image, (bytes, bytearray, memoryview)):
+        logger.warning(f"Ignoring non-binary frame from {session.sid}")
+        return None
+    return image
+
+def _manual_emotion_session(sid: str, data: Dict) -> Optional[DetectionSession]:
+    """Apply a manual emotion selection; None if the emotion is not valid"""
+    emotion = data.get('emotion')
+    if emotion not in EMOTIONS:
+        return None
+    session = sessions.get(sid)
+    detector.set_manual_emotion(session, emotion)
+    session.song_emotion = emotion
+    return session
+
+def _refresh_session(sid: str, data: Dict) -> Optional[DetectionSession]:
+    """Session whose songs should be refreshed; None if the emotion is not valid"""
+    emotion = data.get('emotion')
+    if emotion not in EMOTIONS:
+        return None
+    session = sessions.get(sid)
+    for vid_id in data.get('played_songs', []):  # Older clients
+        session.played.add(vid_id)
+    session.song_emotion = emotion
+    return session
+
+def _record_played(sid: str, data: Dict):
+    """Record played songs; a single videoId, or videoIds to resync after reconnecting"""
+    session = sessions.get(sid)
+    vid_ids = data.get('videoIds') or [data.get('videoId')]
+    for vid_id in vid_ids[-PLAYED_HISTORY_LIMIT:]:
+        if isinstance(vid_id, str) and 0 < len(vid_id) <= 32:
+            session.played.add(vid_id)
+
+def _queue_song_search(session: DetectionSession, emotion: str, played_songs=(), request_id=None):
+    """Search songs in the background and push them to the client when ready"""
+    sid = session.sid
+    
+    def deliver(songs: List[Dict]):
+        update = _songs_update(session, emotion, songs, request_id)
+        if update is not None:
+            socketio.emit('emotion_update', update, to=sid)
+            socketio.emit('status_message', {'message': 'Ready'}, to=sid)
+    
+    accepted = song_search.submit(emotion, played_songs, deliver)
+    emit('status_message', {'message': _search_status(session, emotion, accepted)})
+
+def _process_stats() -> Dict:
+    """CPU time and resident memory of this server process"""
+    times = os.times()
+    try:
+        with open('/proc/self/statm') as f:
+            rss_kib = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, AttributeError):
+        rss_kib = None  # Not Linux
+    return {
+        'worker': WORKER_ID or None,
+        'pid': os.getpid(),
+        'uptime_s': round(time.time() - _process_started, 1),
+        'cpu_seconds': round(times.user + times.system, 3),
+        'rss_kib': rss_kib,
+        'threads': threading.active_count()
+    }
 
 # Flask routes
 @app.route('/')
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+@app.route('/stats')
+def stats():
+    """Runtime statistics for capacity planning"""
+    return jsonify(collect_stats(song_search.stats()))
+
+def collect_stats(search_stats: Dict) -> Dict:
+    """Everything /stats reports; the search section depends on the serving mode"""
+    return {
+        'process': _process_stats(),
+        'sessions': sessions.stats(),
+        'detection': detector.engine.stats(),
+        'search': search_stats,
+        'song_pools': youtube.pool_stats(),
+        'catalog': youtube.catalog_stats(),
+        'queries': youtube.query_stats(),
+        'http': youtube.http.stats()
+    }
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Latency histograms and counters in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def _is_admin(token: Optional[str], remote_addr: Optional[str]) -> bool:
+    """Admin token when one is configured, otherwise requests from this machine"""
+    if ADMIN_TOKEN:
+        return token == ADMIN_TOKEN
+    if WORKER_ID:
+        # Behind the cluster proxy every client appears to come from localhost
+        return False
+    return remote_addr in ('127.0.0.1', '::1')
+
+def _run_profile_command(data: Dict) -> Dict:
+    """start (with duration and sample_rate), stop, or status"""
+    action = data.get('action', 'status')
+    if action == 'start':
+        try:
+            return profiler.start(data.get('duration', 30), data.get('sample_rate', 0.1))
+        except (TypeError, ValueError):
+            return {'error': 'duration and sample_rate must be numbers'}
+    if action == 'stop':
+        profiler.stop()
+    return profiler.status()
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    """Profile socket handlers: POST {"action": "start", "duration": 30, "sample_rate": 0.1}"""
+    data = request.get_json(silent=True) or {}
+    if not _is_admin(request.headers.get('X-Admin-Token') or data.get('token'), request.remote_addr):
+        return jsonify({'error': 'forbidden'}), 403
+    if request.method == 'GET':
+        return jsonify(profiler.status())
+    return jsonify(_run_profile_command(data))
+
 # SocketIO events
 @socketio.on('connect')
 def handle_connect():
     logger.info(f"Client connected: {request.sid}")
+    sessions.create(request.sid)
+    _start_background_services()
     emit('status_message', {'message': 'Connected'})
 
-@socketio.on('process_frame')
-def handle_frame(data):
-    global current_emotion
-    
-    # Get played songs from client
-    played_songs = data.get('played_songs', [])
-    
-    # Process frame
-    result = detector.process_frame(data['image'])
-    
-    # Check if emotion changed
-    if result.get('emotion') and result['emotion'] != current_emotion:
-        current_emotion = result['emotion']
-        
-        # Search for new songs (different each time)
-        emit('status_message', {'message': f'Finding new {current_emotion} songs...'})
-        songs = youtube.search_songs(current_emotion, played_songs)
-        
-        result['songs'] = songs
-        emit('status_message', {'message': 'Ready'})
-        
-        logger.info(f"Emotion: {current_emotion}, New songs: {len(songs)}")
+@socketio.on('disconnect')
+def handle_disconnect():
+    logger.info(f"Client disconnected: {request.sid}")
+    sessions.drop(request.sid)
+
+def _handle_frame_result(session: DetectionSession, result: Dict, no_repeat: bool):
+    """Start a song search on emotion change and report the detection"""
+    emotion = _frame_search_emotion(session, result)
+    if emotion:
+        # Search for new songs (different each time) without holding up frames
+        _queue_song_search(session, emotion, session.played if no_repeat else ())
     
     emit('emotion_update', result)
 
+def _submit_frame(session: DetectionSession, process, image, no_repeat: bool) -> Dict:
+    """Process the freshest frame of a session; stale frames are dropped.
+
+    Only one handler per session drains the mailbox. Frames arriving while
+    it works replace each other, so the drainer always picks up the newest.
+    """
+    processed = session.mailbox.put((process, image, no_repeat))
+    if processed:
+        with contextlib.closing(session.mailbox.drain()) as frames:
+            for process, image, no_repeat in frames:
+                _handle_frame_result(session, process(image, session), no_repeat)
+    
+    return _frame_ack(session, processed)
+
+@socketio.on('process_frame')
+@profiler.profiled('process_frame')
+def handle_frame(data):
+    """Frame as a base64 data URL (older clients that send their full played list)"""
+    session = sessions.get(request.sid)
+    image, no_repeat = _data_url_frame(session, data)
+    return _submit_frame(session, detector.process_frame, image, no_repeat)
+
+@socketio.on('process_frame_binary')
+@profiler.profiled('process_frame_binary')
+def handle_frame_binary(data):
+    """Frame as a JPEG binary attachment; the return value acknowledges it"""
+    session = sessions.get(request.sid)
+    image = _binary_frame(session, data)
+    if image is None:
+        return _frame_ack(session, False)
+    return _submit_frame(session, detector.process_frame_bytes, image, data.get('no_repeat', True))
+
 @socketio.on('manual_emotion')
+@profiler.profiled('manual_emotion')
 def handle_manual_emotion(data):
     """Handle manual emotion selection"""
-    emotion = data.get('emotion')
-    if emotion in ['happy', 'neutral', 'sad']:
-        detector.set_manual_emotion(emotion)
-        
-        # Get new songs for this emotion
-        songs = youtube.search_songs(emotion, [])
-        
+    session = _manual_emotion_session(request.sid, data)
+    if session is not None:
         emit('emotion_update', {
-            'emotion': emotion,
-            'face_detected': True,
-            'songs': songs
+            'emotion': session.song_emotion,
+            'face_detected': True
         })
+        
+        # Get new songs for this emotion
+        _queue_song_search(session, session.song_emotion, request_id=data.get('request_id'))
 
 @socketio.on('refresh_songs')
+@profiler.profiled('refresh_songs')
 def handle_refresh_songs(data):
     """Get new songs for current emotion"""
-    emotion = data.get('emotion')
-    played_songs = data.get('played_songs', [])
-    
-    if emotion in ['happy', 'neutral', 'sad']:
-        songs = youtube.search_songs(emotion, played_songs)
-        
-        emit('emotion_update', {
-            'emotion': emotion,
-            'face_detected': True,
-            'songs': songs
-        })
+    session = _refresh_session(request.sid, data)
+    if session is not None:
+        _queue_song_search(session, session.song_emotion, session.played, data.get('request_id'))
+
+@socketio.on('song_played')
+@profiler.profiled('song_played')
+def handle_song_played(data):
+    """Record played songs; a single videoId, or videoIds to resync after reconnecting"""
+    _record_played(request.sid, data)
+
+@socketio.on('admin_profile')
+def handle_admin_profile(data):
+    """Socket twin of /admin/profile; the return value acknowledges it"""
+    data = data or {}
+    if not _is_admin(data.get('token'), request.remote_addr):
+        return {'error': 'forbidden'}
+    return _run_profile_command(data)
 
 if __name__ == '__main__':
-    port = 5000
+    port = int(os.environ.get('MOODIFY_PORT', 5000))
     logger.info(f"""
     ╔════════════════════════════════════╗
     ║      MOODIFY - DYNAMIC SONGS       ║
@@ -1318,4 +3318,6 @@ if __name__ == '__main__':
     ║  URL: http://localhost:{port}        ║
     ╚════════════════════════════════════╝
     """)
-    socketio.run(app, host='0.0.0.0', port=port, debug=False)
+    _start_background_services()
+    socketio.run(app, host=os.environ.get('MOODIFY_HOST', '0.0.0.0'), port=port, debug=False,
+                 allow_unsafe_werkzeug=True)
@@ -0,0 +1,306 @@
+"""
+Moodify - Asyncio server
+Serves the same page and socket events as app.py from one event loop.
+
+Socket events are coroutines, YouTube pages are fetched with aiohttp, and
+OpenCV work runs on the detection engine's worker threads, so an idle
+connection costs a few KB instead of an OS thread.
+
+Usage: python async_server.py [--host 0.0.0.0] [--port 5000]
+Needs: pip install aiohttp
+"""
+
+import argparse
+import asyncio
+import contextlib
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import socketio
+from aiohttp import web
+
+from app import (HTML_TEMPLATE, HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT, SEARCH_QUEUE_LIMIT,
+                 SEARCH_WORKERS, SESSION_REAP_INTERVAL, DetectionSession, DynamicYouTubeMusic, SearchQueue,
+                 VideoResultsParser, _binary_frame, _data_url_frame, _frame_ack, _frame_search_emotion,
+                 _is_admin, _manual_emotion_session, _record_played, _refresh_session, _run_profile_command,
+                 _search_status, _songs_update, collect_stats, detector, logger, metrics, search_failures,
+                 search_youtube_seconds, sessions, youtube)
+
+class AsyncSongSearch(SearchQueue):
+    """search_songs for the event loop: page fetches never block it"""
+
+    def __init__(self, music: DynamicYouTubeMusic, concurrency: int = SEARCH_WORKERS,
+                 queue_limit: int = SEARCH_QUEUE_LIMIT):
+        super().__init__(queue_limit)
+        self.music = music
+        self._slots = asyncio.Semaphore(concurrency)
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._tasks = set()
+
+    async def start(self):
+        self._http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT))
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+
+    def submit(self, emotion: str, played_songs, callback) -> bool:
+        """Start a search; the coroutine callback receives the songs. False if the queue is full."""
+        if not self._admit():
+            return False
+        task = asyncio.create_task(self._run(emotion, played_songs, callback, time.time()))
+        # The loop only keeps weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, emotion: str, played_songs, callback, queued_at: float):
+        async with self._slots:
+            started = self._begin()
+            songs, error = [], None
+            try:
+                songs = await self.search_songs(emotion, played_songs)
+            except Exception as e:
+                error = e
+            finally:
+                self._finish(started, queued_at, songs, error)
+
+        try:
+            await callback(songs)
+        except Exception as e:
+            logger.error(f"Search callback error: {e}")
+
+    async def search_songs(self, emotion: str, played_songs=()) -> List[Dict]:
+        """DynamicYouTubeMusic.search_songs with non-blocking scrapes"""
+        loop = asyncio.get_running_loop()
+        # The catalog lookup is a short SQLite query, still kept off the loop
+        songs = await loop.run_in_executor(None, self.music.stored_songs, emotion, played_songs)
+        if len(songs) >= 5:
+            self.music.rng.shuffle(songs)
+            return songs
+
+        # Don't hand out the same song twice in one list
+        seen_ids = {song['videoId'] for song in songs}
+
+        for attempt in range(2):
+            query = self.music._generate_dynamic_query(emotion)
+            logger.info(f"Dynamic search: {query}")
+            found = await self.search_youtube(query, played_songs, seen_ids)
+            await loop.run_in_executor(None, self.music._remember, emotion, query, found)
+            songs.extend(found)
+            if attempt == 0:
+                self.music.search_count += 1
+            # If not enough songs, try another query
+            if len(songs) >= 5:
+                break
+
+        return songs[:10]
+
+    async def search_youtube(self, query: str, played_songs=(), seen_ids: Optional[set] = None) -> List[Dict]:
+        """_search_youtube over aiohttp; stops reading the page once enough songs are collected"""
+        started = time.perf_counter()
+        try:
+            path, headers = self.music._search_request(query)
+            parser = VideoResultsParser()
+            songs = []
+            if seen_ids is None:
+                seen_ids = set()
+
+            async with self._http.get(self.music.base_url + path, headers=headers) as response:
+                if response.status != 200:
+                    raise ConnectionError(f"HTTP {response.status} for {path}")
+                async for chunk in response.content.iter_chunked(16384):
+                    if self.music._accept_songs(parser.feed(chunk), played_songs, seen_ids, songs):
+                        break
+                else:
+                    self.music._accept_songs(parser.finish(), played_songs, seen_ids, songs)
+
+            # Shuffle for variety
+            self.music.rng.shuffle(songs)
+            return songs[:10]
+
+        except Exception as e:
+            logger.error(f"YouTube search error: {e!r}")
+            search_failures.inc()
+            return []
+        finally:
+            search_youtube_seconds.observe(time.perf_counter() - started)
+
+sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*')
+song_search = AsyncSongSearch(youtube)
+_remote_addrs: Dict[str, str] = {}  # The aiohttp environ hard-codes REMOTE_ADDR
+
+async def _reap_idle_sessions():
+    """Background task that drops sessions of clients that went quiet"""
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        sessions.reap_idle(lambda sid: sio.manager.is_connected(sid, '/'))
+
+async def _queue_song_search(session: DetectionSession, emotion: str, played_songs=(), request_id=None):
+    """Search songs in the background and push them to the client when ready"""
+    sid = session.sid
+
+    async def deliver(songs: List[Dict]):
+        update = _songs_update(session, emotion, songs, request_id)
+        if update is not None:
+            await sio.emit('emotion_update', update, to=sid)
+            await sio.emit('status_message', {'message': 'Ready'}, to=sid)
+
+    accepted = song_search.submit(emotion, played_songs, deliver)
+    await sio.emit('status_message', {'message': _search_status(session, emotion, accepted)}, to=sid)
+
+async def _handle_frame_result(session: DetectionSession, result: Dict, no_repeat: bool):
+    """Start a song search on emotion change and report the detection"""
+    emotion = _frame_search_emotion(session, result)
+    if emotion:
+        await _queue_song_search(session, emotion, session.played if no_repeat else ())
+
+    await sio.emit('emotion_update', result, to=session.sid)
+
+async def _submit_frame(session: DetectionSession, image, no_repeat: bool) -> Dict:
+    """Process the freshest frame of a session; stale frames are dropped.
+
+    The same mailbox protocol as app._submit_frame: frames arriving while a
+    handler awaits detection replace each other, and that handler picks up
+    the newest when it is done.
+    """
+    processed = session.mailbox.put((image, no_repeat))
+    if processed:
+        # Closing the drain also releases the mailbox on cancellation
+        with contextlib.closing(session.mailbox.drain()) as frames:
+            for image, no_repeat in frames:
+                img_bytes = detector.decode_data_url(image) if isinstance(image, str) else bytes(image)
+                if img_bytes is None:
+                    result = detector._no_face_response()
+                else:
+                    # OpenCV runs on a detection worker, the loop only awaits it
+                    result = await asyncio.wrap_future(detector.submit_frame(img_bytes, session))
+                    result = detector.finish_frame(result, session)
+                await _handle_frame_result(session, result, no_repeat)
+
+    return _frame_ack(session, processed)
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    logger.info(f"Client connected: {sid}")
+    request = environ.get('aiohttp.request')
+    _remote_addrs[sid] = request.remote if request is not None else None
+    sessions.create(sid)
+    await sio.emit('status_message', {'message': 'Connected'}, to=sid)
+
+@sio.event
+async def disconnect(sid, *args):
+    logger.info(f"Client disconnected: {sid}")
+    _remote_addrs.pop(sid, None)
+    sessions.drop(sid)
+
+@sio.on('process_frame')
+async def handle_frame(sid, data):
+    """Frame as a base64 data URL (older clients that send their full played list)"""
+    session = sessions.get(sid)
+    image, no_repeat = _data_url_frame(session, data)
+    return await _submit_frame(session, image, no_repeat)
+
+@sio.on('process_frame_binary')
+async def handle_frame_binary(sid, data):
+    """Frame as a JPEG binary attachment; the return value acknowledges it"""
+    session = sessions.get(sid)
+    image = _binary_frame(session, data)
+    if image is None:
+        return _frame_ack(session, False)
+    return await _submit_frame(session, image, data.get('no_repeat', True))
+
+@sio.on('manual_emotion')
+async def handle_manual_emotion(sid, data):
+    """Handle manual emotion selection"""
+    session = _manual_emotion_session(sid, data)
+    if session is not None:
+        await sio.emit('emotion_update', {
+            'emotion': session.song_emotion,
+            'face_detected': True
+        }, to=sid)
+
+        # Get new songs for this emotion
+        await _queue_song_search(session, session.song_emotion, request_id=data.get('request_id'))
+
+@sio.on('refresh_songs')
+async def handle_refresh_songs(sid, data):
+    """Get new songs for current emotion"""
+    session = _refresh_session(sid, data)
+    if session is not None:
+        await _queue_song_search(session, session.song_emotion, session.played, data.get('request_id'))
+
+@sio.on('song_played')
+async def handle_song_played(sid, data):
+    """Record played songs; a single videoId, or videoIds to resync after reconnecting"""
+    _record_played(sid, data)
+
+@sio.on('admin_profile')
+async def handle_admin_profile(sid, data):
+    """Socket twin of /admin/profile; the return value acknowledges it"""
+    data = data or {}
+    if not _is_admin(data.get('token'), _remote_addrs.get(sid)):
+        return {'error': 'forbidden'}
+    return _run_profile_command(data)
+
+# HTTP routes
+async def index(request: web.Request) -> web.Response:
+    return web.Response(text=HTML_TEMPLATE, content_type='text/html')
+
+async def stats(request: web.Request) -> web.Response:
+    """Runtime statistics for capacity planning"""
+    return web.json_response(collect_stats(song_search.stats()))
+
+async def prometheus_metrics(request: web.Request) -> web.Response:
+    """Latency histograms and counters in the Prometheus text format"""
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def admin_profile(request: web.Request) -> web.Response:
+    """Profile socket handlers: POST {"action": "start", "duration": 30, "sample_rate": 0.1}"""
+    try:
+        data = await request.json() if request.can_read_body else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    if not _is_admin(request.headers.get('X-Admin-Token') or data.get('token'), request.remote):
+        return web.json_response({'error': 'forbidden'}, status=403)
+    if request.method == 'GET':
+        return web.json_response(_run_profile_command({'action': 'status'}))
+    return web.json_response(_run_profile_command(data))
+
+async def _on_startup(web_app: web.Application):
+    await song_search.start()
+    youtube.prewarm()
+    web_app['reaper'] = asyncio.create_task(_reap_idle_sessions())
+
+async def _on_cleanup(web_app: web.Application):
+    web_app['reaper'].cancel()
+    await song_search.close()
+
+def create_app() -> web.Application:
+    web_app = web.Application(client_max_size=4 * 1024 * 1024)
+    sio.attach(web_app)
+    web_app.router.add_get('/', index)
+    web_app.router.add_get('/stats', stats)
+    web_app.router.add_get('/metrics', prometheus_metrics)
+    web_app.router.add_route('GET', '/admin/profile', admin_profile)
+    web_app.router.add_route('POST', '/admin/profile', admin_profile)
+    web_app.on_startup.append(_on_startup)
+    web_app.on_cleanup.append(_on_cleanup)
+    return web_app
+
+def main():
+    parser = argparse.ArgumentParser(description='Moodify on asyncio (python-socketio AsyncServer + aiohttp)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    logger.info(f"Moodify (asyncio) on http://localhost:{args.port}")
+    web.run_app(create_app(), host=args.host, port=args.port, print=None)
+
+if __name__ == '__main__':
+    main()
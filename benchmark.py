@@ -0,0 +1,457 @@
+"""
+Moodify - Benchmarks
+Reproducible timings for the hot paths, runnable without network access.
+
+Usage: python benchmark.py <suite> [options]
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import re
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+from app import (EMOTION_BACKENDS, EMOTIONS, CascadeSet, DetectionSession,
+                 DynamicYouTubeMusic, HeuristicBackend, ImprovedEmotionDetector, iter_video_results)
+from fixture_server import FixtureServer, build_results_page, load_pages
+from measure import load_frames, summarize
+
+def print_report(title: str, rows: Dict[str, Dict], as_json: bool):
+    """Print one result block as a table or as JSON"""
+    if as_json:
+        print(json.dumps({'suite': title, 'results': rows}, indent=2))
+        return
+    print(f"\n== {title} ==")
+    for name, values in rows.items():
+        print(f"{name:<28}" + "  ".join(f"{key}={value}" for key, value in values.items()))
+
+# ---------------------------------------------------------------------------
+# Results page parsing
+# ---------------------------------------------------------------------------
+
+def legacy_parse(page: bytes) -> List:
+    """The previous _search_youtube parsing: full decode plus up to three regex passes"""
+    html = page.decode('utf-8')
+    matches = re.findall(r'"videoId":"([^"]+)".*?"title":{"runs":\[{"text":"([^"]+)"', html)
+    if len(matches) < 10:
+        video_ids = re.findall(r'"videoId":"([^"]+)"', html)
+        titles = re.findall(r'"title":{"runs":\[{"text":"([^"]+)"', html)
+        matches = list(zip(video_ids, titles))
+    return matches
+
+def streaming_parse(page: bytes, limit: int = 0, chunk_size: int = 16384) -> List:
+    """Feed the page through iter_video_results in socket-sized chunks"""
+    chunks = (page[i:i + chunk_size] for i in range(0, len(page), chunk_size))
+    results = []
+    for pair in iter_video_results(chunks):
+        results.append(pair)
+        if limit and len(results) >= limit:
+            break
+    return results
+
+def bench_parser(args):
+    if args.pages:
+        pages = [open(path, 'rb').read() for path in args.pages]
+    else:
+        pages = [build_results_page(seed=seed) for seed in range(args.synthetic)]
+
+    parsers = {
+        'legacy_regex': legacy_parse,
+        'streaming_full': streaming_parse,
+        'streaming_first_15': lambda page: streaming_parse(page, limit=15)
+    }
+    rows = {}
+    for name, parse in parsers.items():
+        cpu_samples = []
+        found = 0
+        for _ in range(args.repeat):
+            for page in pages:
+                start = time.process_time()
+                found += len(parse(page))
+                cpu_samples.append(time.process_time() - start)
+
+        tracemalloc.start()
+        for page in pages:
+            parse(page)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        rows[name] = dict(summarize(cpu_samples),
+                          results_per_page=round(found / (args.repeat * len(pages)), 1),
+                          peak_kib=peak // 1024)
+
+    print_report('parser', rows, args.json)
+
+# ---------------------------------------------------------------------------
+# Recorded frames
+# ---------------------------------------------------------------------------
+
+def decode_gray(frame: bytes):
+    img = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR)
+    return img, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def largest_face(faces):
+    return max(faces, key=lambda f: f[2] * f[3]) if len(faces) else None
+
+def iou(a, b) -> float:
+    """Intersection over union of two (x, y, w, h) boxes"""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union else 0.0
+
+# ---------------------------------------------------------------------------
+# Face detection pyramid
+# ---------------------------------------------------------------------------
+
+def bench_pyramid(args):
+    frames = [decode_gray(frame)[1] for frame in load_frames(args.frames)]
+    detector = ImprovedEmotionDetector(workers=1)
+    cascades = CascadeSet()
+
+    # Full-resolution detections are the reference for recall
+    detector.detection_scale = 1.0
+    reference = [largest_face(detector._detect_faces(cascades, gray)) for gray in frames]
+    with_face = sum(1 for face in reference if face is not None)
+
+    rows = {}
+    for scale in args.scales:
+        detector.detection_scale = scale
+        samples = []
+        hits = 0
+        for _ in range(args.repeat):
+            for gray, expected in zip(frames, reference):
+                start = time.perf_counter()
+                faces = detector._detect_faces(cascades, gray)
+                samples.append(time.perf_counter() - start)
+                found = largest_face(faces)
+                if expected is not None and found is not None and iou(found, expected) >= 0.5:
+                    hits += 1
+        rows[f'scale_{scale}'] = dict(
+            summarize(samples),
+            fps=round(len(samples) / sum(samples), 1) if samples else 0.0,
+            recall=round(hits / (with_face * args.repeat), 3) if with_face else None
+        )
+
+    rows['frames'] = {'total': len(frames), 'with_face_at_full_res': with_face}
+    print_report('pyramid', rows, args.json)
+
+# ---------------------------------------------------------------------------
+# Feature extraction vs classification
+# ---------------------------------------------------------------------------
+
+def face_crops(frames: List[bytes], detector: ImprovedEmotionDetector, cascades: CascadeSet) -> List:
+    """(gray_face, color_face) per frame: the detected face, or the centre when none is found"""
+    crops = []
+    for frame in frames:
+        img, gray = decode_gray(frame)
+        face = largest_face(detector._detect_faces(cascades, gray))
+        x, y, w, h = face if face is not None else (220, 120, 200, 240)
+        crops.append((gray[y:y+h, x:x+w], img[y:y+h, x:x+w]))
+    return crops
+
+def bench_features(args):
+    detector = ImprovedEmotionDetector(workers=1)
+    cascades = CascadeSet()
+    crops = face_crops(load_frames(args.frames), detector, cascades)
+    backend = HeuristicBackend()
+
+    extract, classify = [], []
+    for _ in range(args.repeat):
+        for gray_face, color_face in crops:
+            start = time.perf_counter()
+            features = backend.extract_features(cascades, gray_face, color_face)
+            middle = time.perf_counter()
+            backend.classify_features(features)
+            classify.append(time.perf_counter() - middle)
+            extract.append(middle - start)
+
+    batch = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        matrix = backend.extract_features_batch(cascades, crops)
+        batch.append((time.perf_counter() - start) / max(1, len(crops)))
+
+    print_report('features', {
+        'extract_per_face': summarize(extract),
+        'extract_batched_per_face': summarize(batch),
+        'classify_per_face': summarize(classify),
+        'faces': {'count': len(crops), 'features': list(HeuristicBackend.FEATURE_NAMES),
+                  'matrix_shape': list(matrix.shape)}
+    }, args.json)
+
+# ---------------------------------------------------------------------------
+# Emotion classifier backends
+# ---------------------------------------------------------------------------
+
+def bench_backends(args):
+    detector = ImprovedEmotionDetector(workers=1)
+    cascades = CascadeSet()
+    crops = face_crops(load_frames(args.frames), detector, cascades)
+
+    rows = {}
+    for name in args.backends:
+        try:
+            backend = EMOTION_BACKENDS[name]()
+        except Exception as e:
+            rows[name] = {'error': str(e)}
+            continue
+
+        # First call builds lazy model state, keep it out of the timings
+        backend.classify(cascades, *crops[0])
+
+        samples = []
+        labels = {'happy': 0, 'neutral': 0, 'sad': 0}
+        for _ in range(args.repeat):
+            for frame_count, (gray_face, color_face) in enumerate(crops):
+                start = time.perf_counter()
+                label = backend.classify(cascades, gray_face, color_face, frame_count)
+                samples.append(time.perf_counter() - start)
+                labels[label] = labels.get(label, 0) + 1
+        rows[name] = dict(summarize(samples),
+                          faces_per_sec=round(len(samples) / sum(samples), 1),
+                          labels=labels)
+
+    print_report('backends', rows, args.json)
+
+# ---------------------------------------------------------------------------
+# process_frame stage by stage
+# ---------------------------------------------------------------------------
+
+def frame_stages(detector: ImprovedEmotionDetector, cascades: CascadeSet, session: DetectionSession) -> List:
+    """(name, fn(state)) for each step of process_frame, calling the same methods as the app"""
+
+    def base64_decode(state):
+        state['bytes'] = ImprovedEmotionDetector.decode_data_url(state['data_url'])
+
+    def imdecode(state):
+        state['img'] = ImprovedEmotionDetector.decode_image(state['bytes'])
+
+    def grayscale(state):
+        state['gray'] = cv2.cvtColor(state['img'], cv2.COLOR_BGR2GRAY)
+
+    def signature(state):
+        ImprovedEmotionDetector.frame_signature(state['gray'])
+
+    def face_detection(state):
+        face = largest_face(detector._detect_faces(cascades, state['gray']))
+        state['face_found'] = face is not None
+        # Keep timing the later stages on the centre when no face is found
+        x, y, w, h = face if face is not None else (220, 120, 200, 240)
+        state['gray_face'] = state['gray'][y:y+h, x:x+w]
+        state['color_face'] = state['img'][y:y+h, x:x+w]
+
+    # HeuristicBackend.extract_features, one stage at a time
+    def eye_cascade(state):
+        state['eyes'] = HeuristicBackend.count_eyes(cascades, state['gray_face'])
+
+    def smile_cascade(state):
+        state['smiles'] = HeuristicBackend.count_smiles(cascades, state['gray_face'])
+
+    def brightness(state):
+        state['bands'] = HeuristicBackend.band_brightness(state['gray_face'])
+
+    def hsv(state):
+        state['saturation'], state['value'] = HeuristicBackend.color_means(state['color_face'])
+
+    def canny(state):
+        state['edges'] = HeuristicBackend.edge_density(state['gray_face'])
+
+    def classify(state):
+        features = HeuristicBackend.pack_features(state['eyes'], state['smiles'], state['bands'],
+                                                  state['saturation'], state['value'], state['edges'])
+        state['emotion'] = HeuristicBackend.classify_features(features, session.frame_count)
+
+    def smoothing(state):
+        detector._get_stable_emotion(session, state['emotion'])
+        session.frame_count += 1
+
+    return [(fn.__name__, fn) for fn in (base64_decode, imdecode, grayscale, signature, face_detection,
+                                         eye_cascade, smile_cascade, brightness, hsv, canny, classify,
+                                         smoothing)]
+
+def bench_stages(args):
+    frames = load_frames(args.frames)
+    data_urls = ['data:image/jpeg;base64,' + base64.b64encode(frame).decode('ascii') for frame in frames]
+    detector = ImprovedEmotionDetector(workers=1, detection_scale=args.scale, tracking=False,
+                                       backend='heuristic', similarity_threshold=0)
+    cascades = CascadeSet()
+    stages = frame_stages(detector, cascades, DetectionSession('benchmark'))
+
+    # One untimed pass warms up caches and lazy OpenCV state
+    for data_url in data_urls:
+        state = {'data_url': data_url}
+        for _, fn in stages:
+            fn(state)
+
+    timings = {name: [] for name, _ in stages}
+    totals = []
+    faces = 0
+    for _ in range(args.repeat):
+        for data_url in data_urls:
+            state = {'data_url': data_url}
+            frame_start = time.perf_counter()
+            for name, fn in stages:
+                start = time.perf_counter()
+                fn(state)
+                timings[name].append(time.perf_counter() - start)
+            totals.append(time.perf_counter() - frame_start)
+            faces += state['face_found']
+
+    # Bytes allocated at the peak of each stage; separate pass since tracing slows everything down
+    allocated = {name: 0 for name, _ in stages}
+    tracemalloc.start()
+    for data_url in data_urls:
+        state = {'data_url': data_url}
+        for name, fn in stages:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(state)
+            allocated[name] += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    # The real entry point, including the detection worker hand-off
+    session = DetectionSession('benchmark')
+    end_to_end = []
+    for _ in range(args.repeat):
+        for data_url in data_urls:
+            start = time.perf_counter()
+            detector.process_frame(data_url, session)
+            end_to_end.append(time.perf_counter() - start)
+
+    total_time = sum(totals)
+    rows = {}
+    for name, samples in timings.items():
+        rows[name] = dict(summarize(samples),
+                          share=round(sum(samples) / total_time, 3) if total_time else 0.0,
+                          alloc_kib_per_frame=round(allocated[name] / len(data_urls) / 1024, 1))
+    rows['all_stages'] = dict(summarize(totals),
+                              fps=round(len(totals) / total_time, 1) if total_time else 0.0,
+                              alloc_kib_per_frame=round(sum(allocated.values()) / len(data_urls) / 1024, 1))
+    rows['process_frame'] = dict(summarize(end_to_end),
+                                 fps=round(len(end_to_end) / sum(end_to_end), 1) if end_to_end else 0.0)
+    rows['environment'] = {
+        'frames': len(frames), 'repeat': args.repeat, 'scale': args.scale,
+        'face_rate': round(faces / len(totals), 3) if totals else 0.0,
+        'opencv': cv2.__version__, 'numpy': np.__version__, 'python': platform.python_version(),
+        'cpus': os.cpu_count(), 'opencv_threads': cv2.getNumThreads()
+    }
+    print_report('stages', rows, args.json)
+
+# ---------------------------------------------------------------------------
+# Song search against the fixture server
+# ---------------------------------------------------------------------------
+
+def bench_search(args):
+    server = FixtureServer(load_pages(args.pages, args.synthetic), latency=args.latency, jitter=args.jitter,
+                           failure_rate=args.failure_rate, drop_rate=args.drop_rate, seed=args.seed).start()
+    music = DynamicYouTubeMusic(base_url=server.url, seed=args.seed, catalog_path='')
+    # Every search goes to the server instead of a pre-warmed pool
+    music.pools.clear()
+
+    # Time each scrape; thread CPU time covers decompression and parsing but not the wait
+    scrape_wall, scrape_cpu, scrape_songs = [], [], []
+    lock = threading.Lock()
+    search_youtube = music._search_youtube
+
+    def timed_search_youtube(*a, **kw):
+        start, cpu = time.perf_counter(), time.thread_time()
+        songs = search_youtube(*a, **kw)
+        with lock:
+            scrape_cpu.append(time.thread_time() - cpu)
+            scrape_wall.append(time.perf_counter() - start)
+            scrape_songs.append(len(songs))
+        return songs
+
+    music._search_youtube = timed_search_youtube
+
+    def run(i):
+        start = time.perf_counter()
+        songs = music.search_songs(EMOTIONS[i % len(EMOTIONS)])
+        return time.perf_counter() - start, len(songs)
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(run, range(args.searches)))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    latencies = [latency for latency, _ in results]
+    returned = [count for _, count in results]
+    requests = music.http.stats()['requests']
+    print_report('search', {
+        'search_songs': dict(summarize(latencies),
+                             searches_per_sec=round(len(results) / elapsed, 1),
+                             songs_mean=round(sum(returned) / len(returned), 1),
+                             empty=returned.count(0)),
+        'search_youtube_wall': summarize(scrape_wall),
+        'search_youtube_cpu': summarize(scrape_cpu),
+        'requests': dict(http=requests,
+                         songs_per_request=round(sum(scrape_songs) / requests, 1) if requests else 0.0,
+                         server=server.stats(),
+                         connections=music.http.stats()['connections_opened'])
+    }, args.json)
+
+def main():
+    parser = argparse.ArgumentParser(description='Moodify benchmarks')
+    parser.add_argument('--json', action='store_true', help='emit machine-readable JSON')
+    suites = parser.add_subparsers(dest='suite', required=True)
+
+    parser_suite = suites.add_parser('parser', help='results page parsing CPU time and memory')
+    parser_suite.add_argument('pages', nargs='*', help='saved YouTube results pages (default: synthetic)')
+    parser_suite.add_argument('--synthetic', type=int, default=5, help='synthetic pages when none are given')
+    parser_suite.add_argument('--repeat', type=int, default=20)
+    parser_suite.set_defaults(func=bench_parser)
+
+    pyramid = suites.add_parser('pyramid', help='face detection latency and recall per downscale factor')
+    pyramid.add_argument('frames', nargs='*', help='recorded frames or directories (default: synthetic)')
+    pyramid.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.25])
+    pyramid.add_argument('--repeat', type=int, default=3)
+    pyramid.set_defaults(func=bench_pyramid)
+
+    features = suites.add_parser('features', help='feature extraction and classification time per face')
+    features.add_argument('frames', nargs='*', help='recorded frames or directories (default: synthetic)')
+    features.add_argument('--repeat', type=int, default=3)
+    features.set_defaults(func=bench_features)
+
+    backends = suites.add_parser('backends', help='per-face latency and throughput of each emotion backend')
+    backends.add_argument('frames', nargs='*', help='recorded frames or directories (default: synthetic)')
+    backends.add_argument('--backends', nargs='+', default=list(EMOTION_BACKENDS), choices=list(EMOTION_BACKENDS))
+    backends.add_argument('--repeat', type=int, default=3)
+    backends.set_defaults(func=bench_backends)
+
+    stages = suites.add_parser('stages', help='process_frame time and allocations per pipeline stage')
+    stages.add_argument('frames', nargs='*', help='recorded frames or directories (default: synthetic)')
+    stages.add_argument('--scale', type=float, default=1.0, help='face detection scale')
+    stages.add_argument('--repeat', type=int, default=3)
+    stages.set_defaults(func=bench_stages)
+
+    search = suites.add_parser('search', help='search_songs latency against the local fixture server')
+    search.add_argument('pages', nargs='*', help='saved YouTube results pages (default: synthetic)')
+    search.add_argument('--synthetic', type=int, default=20, help='synthetic pages when none are given')
+    search.add_argument('--searches', type=int, default=60)
+    search.add_argument('--concurrency', type=int, default=1)
+    search.add_argument('--latency', type=float, default=0.05, help='server delay per request in seconds')
+    search.add_argument('--jitter', type=float, default=0.02)
+    search.add_argument('--failure-rate', type=float, default=0.0)
+    search.add_argument('--drop-rate', type=float, default=0.0)
+    search.add_argument('--seed', type=int, default=0, help='seeds query generation and server failures')
+    search.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
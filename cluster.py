@@ -0,0 +1,195 @@
+"""
+Moodify - Multi-process cluster
+Runs several app.py workers behind a sticky proxy so detection and socket
+handling use every core.
+
+Each worker prefixes its engine.io session ids with its worker id; the
+proxy routes a connection by that prefix, or to the least busy worker for
+new sessions. Workers share discovered songs and query history through
+the SQLite catalog (WAL mode), and socket.io emits fan out through a
+message queue: the local broker from message_queue.py by default, or any
+URL Flask-SocketIO understands (redis://, amqp://, ...).
+
+Usage: python cluster.py --workers 4 --port 5000
+"""
+
+import argparse
+import asyncio
+import os
+import secrets
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+import urllib.parse
+
+from message_queue import MessageBroker
+
+HEAD_LIMIT = 64 * 1024  # Largest request head the proxy will buffer
+
+class StickyProxy:
+    """TCP proxy that pins every socket.io session to the worker that created it.
+
+    Only the head of a connection's first request is parsed. WebSocket
+    connections carry one session for their whole life; polling clients
+    send the sid with every request, so keep-alive connections stay on
+    their session's worker too.
+    """
+
+    def __init__(self, worker_ports: List[int], worker_host: str = '127.0.0.1'):
+        self.worker_ports = worker_ports
+        self.worker_host = worker_host
+        self.active = [0] * len(worker_ports)  # Open connections per worker
+        self.routed = [0] * len(worker_ports)
+
+    def pick_worker(self, head: bytes) -> int:
+        """Worker named by the request's sid, else the one with the fewest connections"""
+        try:
+            target = head.split(b'\r\n', 1)[0].split(b' ')[1].decode('latin-1')
+            sid = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query).get('sid', [''])[0]
+            worker = int(sid.split('.', 1)[0]) if '.' in sid else -1
+        except (IndexError, ValueError):
+            worker = -1
+        if 0 <= worker < len(self.worker_ports):
+            return worker
+        return min(range(len(self.worker_ports)), key=lambda i: (self.active[i], self.routed[i]))
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        try:
+            head = await client_reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            client_writer.close()
+            return
+
+        worker = self.pick_worker(head)
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                self.worker_host, self.worker_ports[worker])
+        except OSError:
+            client_writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            client_writer.close()
+            return
+
+        self.active[worker] += 1
+        self.routed[worker] += 1
+        try:
+            upstream_writer.write(head)
+            await asyncio.gather(self._pipe(client_reader, upstream_writer),
+                                 self._pipe(upstream_reader, client_writer))
+        finally:
+            self.active[worker] -= 1
+            for writer in (client_writer, upstream_writer):
+                writer.close()
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            # Half-close so the other direction can finish
+            if writer.can_write_eof() and not writer.is_closing():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port, limit=HEAD_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+class WorkerSupervisor:
+    """Starts app.py workers and restarts any that exit"""
+
+    def __init__(self, count: int, base_port: int, env: Dict[str, str]):
+        self.ports = [base_port + i for i in range(count)]
+        self.env = env
+        self.processes: List[Optional[subprocess.Popen]] = [None] * count
+        self.restarts = 0
+
+    def _spawn(self, index: int) -> subprocess.Popen:
+        env = dict(self.env, MOODIFY_WORKER_ID=str(index), MOODIFY_PORT=str(self.ports[index]),
+                   MOODIFY_HOST='127.0.0.1')
+        app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+        return subprocess.Popen([sys.executable, app_path], env=env, stdin=subprocess.DEVNULL)
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self.processes[index] = self._spawn(index)
+
+    async def watch(self, interval: float = 1.0):
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process.poll() is not None:
+                    print(f"Worker {index} exited with {process.returncode}, restarting", flush=True)
+                    self.restarts += 1
+                    self.processes[index] = self._spawn(index)
+
+    def stop(self):
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        deadline = time.time() + 10
+        for process in self.processes:
+            if process is not None:
+                try:
+                    process.wait(max(0.1, deadline - time.time()))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+def worker_environment(args) -> Dict[str, str]:
+    """Environment shared by every worker"""
+    env = dict(os.environ)
+    env['MOODIFY_MESSAGE_QUEUE'] = args.message_queue or f'local://127.0.0.1:{args.broker_port}'
+    # One shared catalog, whatever directory each worker starts in
+    if env.get('MOODIFY_CATALOG_PATH'):
+        env['MOODIFY_CATALOG_PATH'] = os.path.abspath(env['MOODIFY_CATALOG_PATH'])
+    # Workers see every client as localhost, so admin calls always need a token
+    if not env.get('MOODIFY_ADMIN_TOKEN'):
+        env['MOODIFY_ADMIN_TOKEN'] = secrets.token_urlsafe(24)
+        print(f"Generated admin token for this run: {env['MOODIFY_ADMIN_TOKEN']}", flush=True)
+    # Split the cores between workers unless told otherwise
+    env.setdefault('MOODIFY_DETECTION_WORKERS', str(max(1, (os.cpu_count() or 1) // args.workers)))
+    return env
+
+async def run(args):
+    broker = None
+    if not args.message_queue:
+        broker = MessageBroker('127.0.0.1', args.broker_port).start()
+
+    supervisor = WorkerSupervisor(args.workers, args.worker_port, worker_environment(args))
+    supervisor.start()
+    proxy = StickyProxy(supervisor.ports)
+    print(f"Moodify cluster: {args.workers} workers on ports {supervisor.ports[0]}-{supervisor.ports[-1]}, "
+          f"proxy on http://{args.host}:{args.port}", flush=True)
+    try:
+        await asyncio.gather(proxy.serve(args.host, args.port), supervisor.watch())
+    finally:
+        supervisor.stop()
+        if broker is not None:
+            broker.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Moodify on several processes behind a sticky proxy')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000, help='public port of the proxy')
+    parser.add_argument('--worker-port', type=int, default=5100, help='first worker port')
+    parser.add_argument('--broker-port', type=int, default=5099, help='port of the local message broker')
+    parser.add_argument('--message-queue', default='', help='external queue URL instead of the local broker')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Moodify - Fixture YouTube server
+Replays recorded results pages so song searches run without network access.
+
+Usage: python fixture_server.py [pages ...] [--port 8765] [--latency 0.05] [--failure-rate 0.1]
+then start the app with MOODIFY_YOUTUBE_BASE_URL=http://127.0.0.1:8765
+"""
+
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import urllib.parse
+
+def build_results_page(count: int = 40, seed: int = 0) -> bytes:
+    """Synthetic YouTube results page shaped like the real ytInitialData markup"""
+    rng = random.Random(seed)
+    renderers = []
+    for i in range(count):
+        vid_id = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_') for _ in range(11))
+        renderers.append({
+            'videoRenderer': {
+                'videoId': vid_id,
+                'thumbnail': {'thumbnails': [
+                    {'url': f'https://i.ytimg.com/vi/{vid_id}/hq720.jpg?sqp={"x" * rng.randint(80, 200)}',
+                     'width': 720, 'height': 404}
+                ]},
+                'title': {'runs': [{'text': f'Bollywood Song {i} & Official Video'}]},
+                'longBylineText': {'runs': [{'text': f'Channel {rng.randint(1, 500)}'}]},
+                'viewCountText': {'simpleText': f'{rng.randint(1000, 10 ** 8)} views'},
+                'navigationEndpoint': {'commandMetadata': {'webCommandMetadata': {
+                    'url': f'/watch?v={vid_id}', 'rootVe': 3832}}},
+                'trackingParams': 'y' * rng.randint(200, 600)
+            }
+        })
+    data = json.dumps({'contents': {'sectionListRenderer': {'contents': renderers}}}, separators=(',', ':'))
+    # Real pages carry several hundred KB of scripts and styles around the data
+    filler = '<script>' + 'var a=1;' * 40000 + '</script>'
+    return (f'<!DOCTYPE html><html><head>{filler}</head><body>'
+            f'<script>var ytInitialData = {data};</script>{filler}</body></html>').encode('utf-8')
+
+def load_pages(paths: List[str], synthetic: int = 20) -> List[bytes]:
+    """Recorded results pages from disk, or synthetic ones when none are given"""
+    pages = [open(path, 'rb').read() for path in paths]
+    return pages or [build_results_page(seed=seed) for seed in range(synthetic)]
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves /results like YouTube, one recorded page per query"""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real site
+
+    def do_GET(self):
+        fixture = self.server.fixture
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path != '/results':
+            self._reply(404, b'Not found')
+            return
+
+        outcome, delay = fixture.next_outcome()
+        if delay:
+            time.sleep(delay)
+        if outcome == 'drop':
+            # Hang up without answering, like a reset connection
+            self.close_connection = True
+            return
+        if outcome == 'error':
+            self._reply(503, b'Service unavailable')
+            return
+
+        query = urllib.parse.parse_qs(parts.query).get('search_query', [''])[0]
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        self._reply(200, fixture.page_for(query, gzipped), 'text/html; charset=utf-8', gzipped)
+
+    def _reply(self, status: int, body: bytes, content_type: str = 'text/plain', gzipped: bool = False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.fixture.verbose:
+            super().log_message(format, *args)
+
+class FixtureServer:
+    """Threaded HTTP server replaying results pages with configurable latency and failures"""
+
+    def __init__(self, pages: List[bytes], host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0,
+                 drop_rate: float = 0.0, seed: int = 0, verbose: bool = False):
+        self.pages = pages
+        self._gzipped = [gzip.compress(page, 6) for page in pages]
+        self.latency = latency  # Seconds before each reply
+        self.jitter = jitter  # Uniform +/- seconds around latency
+        self.failure_rate = failure_rate  # Share of requests answered with 503
+        self.drop_rate = drop_rate  # Share of requests hung up on
+        self.verbose = verbose
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.drops = 0
+        self._httpd = ThreadingHTTPServer((host, port), FixtureHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fixture = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def page_for(self, query: str, gzipped: bool = False) -> bytes:
+        """The same query always gets the same page"""
+        index = zlib.crc32(query.encode('utf-8')) % len(self.pages)
+        return self._gzipped[index] if gzipped else self.pages[index]
+
+    def next_outcome(self):
+        """('ok' | 'error' | 'drop', delay in seconds) for the next request"""
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            roll = self._rng.random()
+            if roll < self.drop_rate:
+                self.drops += 1
+                return 'drop', delay
+            if roll < self.drop_rate + self.failure_rate:
+                self.failures += 1
+                return 'error', delay
+            return 'ok', delay
+
+    def start(self) -> 'FixtureServer':
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fixture-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'requests': self.requests, 'failures': self.failures, 'drops': self.drops}
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay YouTube results pages for offline searches')
+    parser.add_argument('pages', nargs='*', help='saved YouTube results pages (default: synthetic)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--synthetic', type=int, default=20, help='synthetic pages when none are given')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='uniform +/- seconds around the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='share of requests hung up on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = FixtureServer(load_pages(args.pages, args.synthetic), args.host, args.port,
+                           latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                           drop_rate=args.drop_rate, seed=args.seed, verbose=args.verbose)
+    print(f"Serving {len(server.pages)} pages on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
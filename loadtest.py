@@ -0,0 +1,324 @@
+"""
+Moodify - Load test
+Simulates many camera clients against a running server and writes a capacity report.
+
+Usage: python loadtest.py --url http://127.0.0.1:5000 --clients 50 --fps 5 --duration 60
+Needs the socket.io client: pip install "python-socketio[client]"
+"""
+
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import urllib.request
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import socketio
+
+from measure import load_frames, summarize
+
+EMOTIONS = ('happy', 'neutral', 'sad')
+
+def fetch_stats(url: str) -> Optional[Dict]:
+    try:
+        with urllib.request.urlopen(f'{url}/stats', timeout=5) as response:
+            return json.loads(response.read())
+    except Exception:
+        return None
+
+class SimulatedClient:
+    """One camera client: frames at a fixed rate, with mood switches and refreshes.
+
+    Like the browser it keeps at most one frame in flight, so every frame
+    emotion_update belongs to the frame that is outstanding. Ticks that
+    find the previous frame unanswered are counted as skipped. Song
+    requests carry a request_id that the server echoes with the songs;
+    songs pushed by a frame's emotion change have none.
+    """
+
+    def __init__(self, index: int, args, frames: List[bytes], results: 'LoadResults'):
+        self.index = index
+        self.args = args
+        self.frames = frames
+        self.results = results
+        self.rng = random.Random(args.seed + index)
+        self.sio = socketio.Client(reconnection=False)
+        self._inflight = None  # Send time of the outstanding frame
+        self._song_requests: Dict[int, Tuple[float, str]] = {}  # Send time and emotion of outstanding requests
+        self._next_request_id = 0
+        self._lock = threading.Lock()
+        self.sio.on('emotion_update', self._on_emotion_update)
+
+    def _on_emotion_update(self, data):
+        now = time.perf_counter()
+        with self._lock:
+            if 'songs' in data:
+                requested = self._song_requests.pop(data.get('request_id'), None)
+                if requested is not None:
+                    self.results.record('songs', now - requested[0])
+                else:
+                    self.results.count('songs_pushed')
+            elif 'next_interval_ms' in data and self._inflight is not None:
+                self.results.record('frame', now - self._inflight)
+                self._inflight = None
+
+    def _on_ack(self, ack=None):
+        # A processed frame's emotion_update is on its way, or already here
+        if ack and ack.get('processed'):
+            return
+        with self._lock:
+            if self._inflight is not None:
+                self.results.count('unanswered')
+                self._inflight = None
+
+    def _send_frame(self):
+        frame = self.frames[self.rng.randrange(len(self.frames))]
+        if self.args.binary:
+            self.sio.emit('process_frame_binary', {'image': frame, 'no_repeat': True}, callback=self._on_ack)
+        else:
+            image = 'data:image/jpeg;base64,' + base64.b64encode(frame).decode('ascii')
+            self.sio.emit('process_frame', {'image': image, 'played_songs': []}, callback=self._on_ack)
+
+    def run(self, start_at: float, stop_at: float):
+        try:
+            self.sio.connect(self.args.url, transports=['websocket'], wait_timeout=10)
+        except Exception as e:
+            self.results.error(f'connect: {e}')
+            return
+        self.results.connected()
+
+        interval = 1.0 / self.args.fps
+        # Spread clients over one frame interval so they don't fire in lockstep
+        next_frame = start_at + self.rng.uniform(0, interval)
+        next_manual = start_at + self.rng.uniform(0, self.args.manual_every) if self.args.manual_every else None
+        next_refresh = start_at + self.rng.uniform(0, self.args.refresh_every) if self.args.refresh_every else None
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= stop_at:
+                    break
+                with self._lock:
+                    # A reply overdue past the timeout counts as lost
+                    if self._inflight is not None and now - self._inflight > self.args.timeout:
+                        self.results.count('timed_out')
+                        self._inflight = None
+                    for request_id, (requested, _) in list(self._song_requests.items()):
+                        if now - requested > self.args.timeout:
+                            self.results.count('songs_timed_out')
+                            del self._song_requests[request_id]
+
+                if now >= next_frame:
+                    with self._lock:
+                        busy = self._inflight is not None
+                        if not busy:
+                            self._inflight = now
+                    if busy:
+                        self.results.count('skipped')
+                    else:
+                        self.results.count('sent')
+                        self._send_frame()
+                    next_frame += interval
+
+                if next_manual is not None and now >= next_manual:
+                    self._request_songs('manual_emotion', now)
+                    next_manual += self.args.manual_every
+                if next_refresh is not None and now >= next_refresh:
+                    self._request_songs('refresh_songs', now)
+                    next_refresh += self.args.refresh_every
+
+                time.sleep(max(0.0, min(next_frame, stop_at) - time.perf_counter()))
+        except Exception as e:
+            self.results.error(f'client {self.index}: {e}')
+        finally:
+            self.sio.disconnect()
+
+    def _request_songs(self, event: str, now: float):
+        emotion = self.rng.choice(EMOTIONS)
+        with self._lock:
+            # The server drops results for an emotion the client has since left
+            for pending, (_, pending_emotion) in list(self._song_requests.items()):
+                if pending_emotion != emotion:
+                    self.results.count('songs_superseded')
+                    del self._song_requests[pending]
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            self._song_requests[request_id] = (now, emotion)
+        self.results.count(event)
+        self.sio.emit(event, {'emotion': emotion, 'request_id': request_id})
+
+class LoadResults:
+    """Latencies and counters shared by every simulated client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {'frame': [], 'songs': []}
+        self.answered_at = []  # When each frame reply arrived
+        self.connected_at = []
+        self.counters = {}
+        self.errors = []
+
+    def record(self, kind: str, seconds: float):
+        with self._lock:
+            self.latencies[kind].append(seconds)
+            if kind == 'frame':
+                self.answered_at.append(time.perf_counter())
+
+    def connected(self):
+        with self._lock:
+            self.connected_at.append(time.perf_counter())
+            self.counters['connected'] = self.counters.get('connected', 0) + 1
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def error(self, message: str):
+        with self._lock:
+            self.errors.append(message)
+
+def sample_server(url: str, stop: threading.Event, samples: List[Dict], period: float = 1.0):
+    """Poll the server's process stats until stopped"""
+    while not stop.wait(period):
+        stats = fetch_stats(url)
+        if stats and 'process' in stats:
+            samples.append(dict(stats['process'], at=time.time(),
+                                sessions=stats.get('sessions', {}).get('active', 0)))
+
+def server_usage(samples: List[Dict]) -> Dict:
+    """CPU utilisation and memory from consecutive process samples"""
+    if len(samples) < 2:
+        return {}
+    cpu = [(b['cpu_seconds'] - a['cpu_seconds']) / max(1e-6, b['at'] - a['at'])
+           for a, b in zip(samples, samples[1:])]
+    rss = [sample['rss_kib'] for sample in samples if sample.get('rss_kib') is not None]
+    return {
+        'cpu_percent_mean': round(100 * sum(cpu) / len(cpu), 1),
+        'cpu_percent_peak': round(100 * max(cpu), 1),
+        'rss_mib_start': round(rss[0] / 1024, 1) if rss else None,
+        'rss_mib_peak': round(max(rss) / 1024, 1) if rss else None,
+        'threads_peak': max(sample.get('threads', 0) for sample in samples),
+        'sessions_peak': max(sample.get('sessions', 0) for sample in samples)
+    }
+
+def build_report(args, results: LoadResults, samples: List[Dict], after: Optional[Dict],
+                 finished: float) -> Dict:
+    frame = summarize(results.latencies['frame'], digits=1)
+    # Throughput over the steady phase only, once the last client has connected
+    steady_start = max(results.connected_at, default=finished)
+    steady = finished - steady_start
+    steady_answered = sum(1 for at in results.answered_at if steady_start <= at <= finished)
+    late = sum(1 for latency in results.latencies['frame'] if latency > args.late_ms / 1000)
+    sent = results.counters.get('sent', 0)
+    lost = results.counters.get('timed_out', 0) + results.counters.get('unanswered', 0)
+    report = {
+        'label': args.label,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'url': args.url, 'clients': args.clients, 'fps': args.fps, 'duration_s': args.duration,
+            'event': 'process_frame_binary' if args.binary else 'process_frame',
+            'frames': args.frames_count, 'late_ms': args.late_ms, 'timeout_s': args.timeout
+        },
+        'frames': {
+            'offered': sent + results.counters.get('skipped', 0),
+            'sent': sent,
+            'answered': frame['count'],
+            'answered_per_sec': round(steady_answered / steady, 1) if steady > 0 else 0.0,
+            'steady_s': round(steady, 1),
+            'skipped': results.counters.get('skipped', 0),
+            'late': late,
+            'lost': lost,
+            'lost_ratio': round(lost / sent, 4) if sent else 0.0
+        },
+        'frame_rtt': frame,
+        'song_rtt': dict(summarize(results.latencies['songs'], digits=1),
+                         requests=results.counters.get('manual_emotion', 0) + results.counters.get('refresh_songs', 0),
+                         timed_out=results.counters.get('songs_timed_out', 0),
+                         superseded=results.counters.get('songs_superseded', 0),
+                         pushed_by_frames=results.counters.get('songs_pushed', 0)),
+        'clients': {'connected': results.counters.get('connected', 0), 'errors': results.errors[:20]},
+        'server': server_usage(samples)
+    }
+    if after:
+        report['server']['search'] = after.get('search')
+    return report
+
+def compare(report: Dict, baseline: Dict):
+    """Print the headline numbers next to a previous report"""
+    rows = [
+        ('frames answered/s', ('frames', 'answered_per_sec')),
+        ('frame rtt p50 ms', ('frame_rtt', 'p50_ms')),
+        ('frame rtt p95 ms', ('frame_rtt', 'p95_ms')),
+        ('frame rtt p99 ms', ('frame_rtt', 'p99_ms')),
+        ('frames lost ratio', ('frames', 'lost_ratio')),
+        ('song rtt p95 ms', ('song_rtt', 'p95_ms')),
+        ('server cpu % mean', ('server', 'cpu_percent_mean')),
+        ('server rss MiB peak', ('server', 'rss_mib_peak'))
+    ]
+    print(f"\n{'':<22}{baseline.get('label') or 'baseline':>14}{report.get('label') or 'current':>14}")
+    for name, (section, key) in rows:
+        old = baseline.get(section, {}).get(key)
+        new = report.get(section, {}).get(key)
+        print(f"{name:<22}{str(old):>14}{str(new):>14}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Moodify socket.io load test')
+    parser.add_argument('frames', nargs='*', help='recorded JPEG frames or directories (default: synthetic)')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--fps', type=float, default=5.0, help='frames per second per client')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--ramp', type=float, default=5.0, help='seconds over which clients connect')
+    parser.add_argument('--manual-every', type=float, default=20.0, help='seconds between manual_emotion, 0 disables')
+    parser.add_argument('--refresh-every', type=float, default=30.0, help='seconds between refresh_songs, 0 disables')
+    parser.add_argument('--binary', action='store_true', help='send process_frame_binary instead of base64 process_frame')
+    parser.add_argument('--late-ms', type=float, default=500.0, help='frame replies slower than this count as late')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a reply counts as lost')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='', help='name of this run in the report, e.g. a release')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='previous JSON report to compare against')
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames, synthetic=20)
+    args.frames_count = len(frames)
+    results = LoadResults()
+    clients = [SimulatedClient(i, args, frames, results) for i in range(args.clients)]
+
+    samples = []
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_server, args=(args.url, stop, samples), daemon=True)
+    sampler.start()
+
+    # Clients connect one by one over the ramp, then all run until stop_at
+    start = time.perf_counter()
+    stop_at = start + args.ramp + args.duration
+    threads = []
+    for i, client in enumerate(clients):
+        start_at = start + args.ramp * i / max(1, len(clients))
+        thread = threading.Thread(target=client.run, args=(start_at, stop_at), daemon=True)
+        threads.append(thread)
+    for i, thread in enumerate(threads):
+        time.sleep(max(0.0, start + args.ramp * i / max(1, len(threads)) - time.perf_counter()))
+        thread.start()
+    for thread in threads:
+        thread.join()
+    finished = min(time.perf_counter(), stop_at)  # Not counting disconnects
+
+    stop.set()
+    sampler.join()
+    after = fetch_stats(args.url)
+
+    report = build_report(args, results, samples, after, finished)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
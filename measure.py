@@ -0,0 +1,65 @@
+"""
+Moodify - Measurement helpers
+Percentiles, latency summaries and test frames shared by app.py,
+benchmark.py and loadtest.py, so all three report the same p95/p99.
+"""
+
+import math
+import os
+from typing import Dict, List
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(math.ceil(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(samples: List[float], digits: int = 3) -> Dict:
+    """Count, mean, percentiles and max of durations in seconds, in ms"""
+    if not samples:
+        return {'count': 0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(1000 * sum(ordered) / len(ordered), digits),
+        'p50_ms': round(1000 * percentile(ordered, 50), digits),
+        'p95_ms': round(1000 * percentile(ordered, 95), digits),
+        'p99_ms': round(1000 * percentile(ordered, 99), digits),
+        'max_ms': round(1000 * ordered[-1], digits)
+    }
+
+def load_frames(paths: List[str], synthetic: int = 50) -> List[bytes]:
+    """JPEG bytes from files or directories of images, or synthetic frames"""
+    # Imported here so percentile and summarize work without OpenCV
+    import cv2
+    import numpy as np
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        else:
+            files.append(path)
+
+    frames = []
+    for path in files:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        # Same size and quality the browser sends
+        img = cv2.resize(img, (640, 480), interpolation=cv2.INTER_AREA)
+        frames.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes())
+    if frames:
+        return frames
+
+    # Noise with a bright oval: exercises timing only, cascades rarely fire on it
+    rng = np.random.default_rng(0)
+    for _ in range(synthetic):
+        img = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        img = cv2.GaussianBlur(img, (9, 9), 0)
+        cv2.ellipse(img, (320, 240), (90, 120), 0, 0, 360, (170, 190, 220), -1)
+        frames.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 70])[1].tobytes())
+    return frames
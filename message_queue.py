@@ -0,0 +1,213 @@
+"""
+Moodify - Local message queue
+A minimal pub/sub broker and socket.io client manager that stand in for
+Redis when every worker runs on one host.
+
+Usage: python message_queue.py [--port 5099]
+then start workers with MOODIFY_MESSAGE_QUEUE=local://127.0.0.1:5099
+"""
+
+import argparse
+import json
+import logging
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Dict, Optional
+import urllib.parse
+
+import socketio
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>I')  # Frame length prefix
+MAX_FRAME = 16 * 1024 * 1024
+
+def send_frame(sock: socket.socket, payload: bytes):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+def recv_frame(sock: socket.socket) -> Optional[bytes]:
+    """Next length-prefixed frame, None once the peer has closed"""
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ConnectionError(f"Frame of {length} bytes exceeds the limit")
+    return _recv_exact(sock, length)
+
+def _recv_exact(sock: socket.socket, size: int) -> Optional[bytes]:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """One connection: a hello frame naming its role and channel, then messages"""
+
+    def handle(self):
+        broker = self.server.broker
+        hello = recv_frame(self.request)
+        if hello is None:
+            return
+        hello = json.loads(hello)
+        channel = hello.get('channel', '')
+        if hello.get('role') == 'sub':
+            subscriber = (self.request, threading.Lock())
+            broker._subscribe(channel, subscriber)
+            try:
+                # Subscribers never send; this returns when they hang up
+                while self.request.recv(1):
+                    pass
+            except OSError:
+                pass
+            finally:
+                broker._unsubscribe(channel, subscriber)
+        else:
+            while True:
+                payload = recv_frame(self.request)
+                if payload is None:
+                    return
+                broker._relay(channel, payload)
+
+class _BrokerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class MessageBroker:
+    """Threaded TCP relay: every published frame goes to every subscriber of its channel"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5099):
+        self._server = _BrokerServer((host, port), _BrokerHandler)
+        self._server.broker = self
+        self._subscribers: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'local://{host}:{port}'
+
+    def _subscribe(self, channel: str, subscriber):
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+
+    def _unsubscribe(self, channel: str, subscriber):
+        with self._lock:
+            self._subscribers.get(channel, set()).discard(subscriber)
+
+    def _relay(self, channel: str, payload: bytes):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+            self.published += 1
+        delivered = 0
+        for sock, send_lock in subscribers:
+            try:
+                with send_lock:
+                    send_frame(sock, payload)
+                delivered += 1
+            except OSError:
+                self._unsubscribe(channel, (sock, send_lock))
+        with self._lock:
+            self.delivered += delivered
+
+    def start(self) -> 'MessageBroker':
+        """Serve in a background thread"""
+        threading.Thread(target=self._server.serve_forever, name='message-broker', daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'published': self.published,
+                'delivered': self.delivered
+            }
+
+class LocalBrokerManager(socketio.PubSubManager):
+    """socket.io client manager that fans out through a MessageBroker.
+
+    A drop-in for socketio.RedisManager: emits for clients connected to
+    another worker travel through the broker.
+    """
+
+    name = 'local'
+
+    def __init__(self, url: str = 'local://127.0.0.1:5099', channel: str = 'flask-socketio',
+                 write_only: bool = False, logger=None):
+        parts = urllib.parse.urlsplit(url)
+        self.address = (parts.hostname or '127.0.0.1', parts.port or 5099)
+        self._publisher: Optional[socket.socket] = None
+        self._publish_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _connect(self, role: str) -> socket.socket:
+        sock = socket.create_connection(self.address, timeout=5)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(sock, json.dumps({'role': role, 'channel': self.channel}).encode('utf-8'))
+        return sock
+
+    def _publish(self, data):
+        payload = self.json.dumps(data).encode('utf-8')
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect('pub')
+                    send_frame(self._publisher, payload)
+                    return
+                except OSError as e:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                        self._publisher = None
+                    if attempt:
+                        self._get_logger().error(f"Cannot publish to {self.address}: {e}")
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                sock = self._connect('sub')
+                retry_sleep = 1
+                try:
+                    while True:
+                        payload = recv_frame(sock)
+                        if payload is None:
+                            break
+                        yield payload.decode('utf-8')
+                finally:
+                    sock.close()
+            except OSError as e:
+                self._get_logger().error(f"Cannot receive from {self.address}, retrying in {retry_sleep}s: {e}")
+            time.sleep(retry_sleep)
+            retry_sleep = min(60, retry_sleep * 2)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local pub/sub broker for socket.io fan-out')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+    broker = MessageBroker(args.host, args.port)
+    print(f"Message broker on {broker.url}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
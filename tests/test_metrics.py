@@ -0,0 +1,34 @@
+import gc
+import threading
+
+from app import MetricCounter, MetricHistogram
+
+
+def _run_threads(target, count):
+    for _ in range(count):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+    gc.collect()
+
+
+def test_counter_folds_exited_threads():
+    counter = MetricCounter('test_total', 'Test counter')
+    _run_threads(counter.inc, 200)
+    assert len(counter._shards) <= 1
+    assert counter._totals()[0] == 200
+
+
+def test_histogram_folds_exited_threads():
+    histogram = MetricHistogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0))
+    _run_threads(lambda: histogram.observe(0.5), 50)
+    assert len(histogram._shards) <= 1
+    assert histogram._totals() == [0, 50, 0, 25.0]
+
+
+def test_live_thread_keeps_its_shard():
+    counter = MetricCounter('test_live_total', 'Test counter')
+    counter.inc(3)
+    _run_threads(counter.inc, 10)
+    assert len(counter._shards) == 1
+    assert counter._totals()[0] == 13